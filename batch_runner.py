@@ -0,0 +1,214 @@
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import signal
+import sys
+import time
+import cycle_detection
+import day11_seatingPlanSimulation as day11
+import day24_flippingTiles as day24
+
+# Batch runner: run the simulations on many input files, e.g. every night, and stream a JSON line of results per file.
+
+# Running the scripts once per file pays for starting python and importing numpy every time, so instead the files are
+# spread over a pool of worker processes that stay up for the whole batch. Each file is read to tell whether it is a
+# seating plan (day 11) or tile instructions (day 24), and its result is written as soon as it finishes, in the order
+# they finish. Only a couple of files per worker are submitted at a time, so a huge batch is never all queued in
+# memory, and each file has a time limit: the worker stops it with an alarm and moves on to the next file, so one
+# pathological input cannot stall the batch (the alarm needs a unix system, elsewhere there is no time limit).
+# Run with: python batch_runner.py inputs/ 'more_inputs/*.txt' --workers 4 --timeout 60 --output results.jsonl
+
+# bytes read from the start of a file to tell what it is
+DETECT_BYTES = 1 << 16
+
+SEATING_BYTES = set(b'L.#\r\n')
+TILE_BYTES = set(b'nsew\r\n')
+
+
+class InputTimeout(Exception):
+    """raised in a worker when an input runs past its time limit"""
+
+
+def detect_input_type(file_path):
+    """returns 'seating' for a seating plan, 'tiles' for tile instructions, or None if it is neither"""
+    with open(file_path, 'rb') as f:
+        head = set(f.read(DETECT_BYTES))
+
+    letters = head - set(b'\r\n')
+    if not letters:
+        return None
+    if head <= SEATING_BYTES:
+        return 'seating'
+    if head <= TILE_BYTES:
+        return 'tiles'
+    return None
+
+
+def expand_inputs(patterns):
+    """returns the files in the directories and glob patterns (or plain paths), sorted, without duplicates"""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.update(entry.path for entry in os.scandir(pattern)
+                         if entry.is_file() and not entry.name.startswith('.'))
+        else:
+            files.update(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return sorted(files)
+
+
+def raise_timeout(signum, frame):
+    raise InputTimeout()
+
+
+def init_worker():
+    """runs once in each worker, so the alarm stops an input instead of the worker"""
+    if hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, raise_timeout)
+
+
+def run_seating_plan(file_path, options):
+    """
+    runs both seating plan simulations, and returns the occupied seats and iterations of each. The plan is loaded with
+    day11.load_seat_plan, so a ragged plan is a ValueError naming the row
+    """
+    # the cached runs load the plan themselves, and only if it is not cached
+    sp = None if options['cache_dir'] else day11.load_seat_plan(file_path)
+    result = {}
+    for part in (1, 2):
+        if options['cache_dir']:
+            sp_final, stab_list = day11.cached_run_part(file_path, part, 'vectorised', options['cache_dir'])
+        else:
+            sp_final, stab_list = day11.run_part(sp, part)
+        result[f'part{part}'] = int(day11.occupied_seat_count(sp_final))
+        result[f'part{part}_iterations'] = len(stab_list)
+    return result
+
+
+def run_tile_instructions(file_path, options):
+    """
+    counts the black tiles after following the instructions, and after the simulation, with the number of generations
+    simulated (fewer than asked for if the tiles reached a fixed point or a cycle)
+    """
+    generations = options['generations']
+    tiles_dict = day24.load_tiles_dict(file_path, num_workers=0)
+    result = {'part1': day24.number_black_tiles(tiles_dict)}
+
+    if options['cache_dir']:
+        _, numb_black_list, iterations = day24.cached_set_simulation(file_path, generations, options['cache_dir'])
+        result['part2'] = numb_black_list[-1]
+    else:
+        sim_run = day24.simulate_black_tiles(day24.black_tiles_set(tiles_dict), generations)
+        result['part2'] = cycle_detection.count_at_generation(sim_run, generations)
+        iterations = sim_run.generation
+    result['part2_iterations'] = iterations
+    return result
+
+
+def run_input(file_path, options):
+    """worker, runs the simulations on one input file within the time limit, and returns its JSON record"""
+    record = {'input': file_path}
+    start = time.perf_counter()
+    timeout = options['timeout']
+    use_alarm = bool(timeout) and hasattr(signal, 'setitimer')
+
+    try:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        input_type = detect_input_type(file_path)
+        record['type'] = input_type
+        if input_type == 'seating':
+            record.update(run_seating_plan(file_path, options))
+        elif input_type == 'tiles':
+            record.update(run_tile_instructions(file_path, options))
+        else:
+            raise ValueError('not a seating plan or tile instructions')
+        record['status'] = 'ok'
+    except InputTimeout:
+        record['status'] = 'timeout'
+        record['error'] = f'took longer than {timeout} seconds'
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def run_batch(file_paths, out=sys.stdout, num_workers=None, timeout=None, generations=100, cache_dir=None,
+              max_pending=None):
+    """
+    Run every input file on a pool of num_workers processes (default: one per cpu), writing its JSON record to out as
+    soon as it finishes. At most max_pending files (default: two per worker) are submitted at a time. Returns the
+    number of inputs of each status.
+    """
+    num_workers = num_workers or os.cpu_count()
+    max_pending = max_pending or 2 * num_workers
+    options = {'timeout': timeout, 'generations': generations, 'cache_dir': cache_dir}
+    statuses = {}
+
+    def write(record):
+        statuses[record['status']] = statuses.get(record['status'], 0) + 1
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+
+    def write_done(future):
+        file_path = pending_inputs.pop(future)
+        try:
+            record = future.result()
+        except concurrent.futures.BrokenExecutor: # a worker died, so the pool cannot go on
+            raise
+        except Exception as e: # e.g. the record could not be sent back
+            record = {'input': file_path, 'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+        write(record)
+
+    pending_inputs = {}
+    with concurrent.futures.ProcessPoolExecutor(num_workers, initializer=init_worker) as executor:
+        for file_path in file_paths:
+            # wait for a file to finish before submitting more
+            if len(pending_inputs) >= max_pending:
+                done, _ = concurrent.futures.wait(pending_inputs, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    write_done(future)
+            pending_inputs[executor.submit(run_input, file_path, options)] = file_path
+
+        for future in concurrent.futures.as_completed(list(pending_inputs)):
+            write_done(future)
+
+    return statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the day 11 and day 24 simulations on a batch of input files.')
+    parser.add_argument('inputs', nargs='+', help='input files, directories or glob patterns')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per cpu)')
+    parser.add_argument('--timeout', type=float, default=None, help='time limit per input, in seconds')
+    parser.add_argument('--generations', type=int, default=100, help='generations of the tile simulation')
+    parser.add_argument('--cache-dir', help='directory to cache the results in (see result_cache.py)')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='inputs submitted at a time (default: 2 per worker)')
+    parser.add_argument('--output', help='file to write the JSON lines to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    file_paths = expand_inputs(args.inputs)
+    if not file_paths:
+        parser.error('no input files found')
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        statuses = run_batch(file_paths, out, args.workers, args.timeout, args.generations, args.cache_dir,
+                             args.max_pending)
+    finally:
+        if args.output:
+            out.close()
+
+    print(f'{len(file_paths)} inputs: ' + ', '.join(f'{n} {status}' for status, n in sorted(statuses.items())),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import numba_backend
+import day11_seatingPlanSimulation as day11
+import day24_flippingTiles as day24
+
+# Benchmarks for both simulations, on seeded synthetic inputs at several scales.
+
+# Every benchmark is timed a few times (the best and mean are reported) and run once more under tracemalloc to find its
+# peak memory. The results are written as one JSON object per line, with the git commit they were run on, so runs on
+# different commits can be compared. Run with: python benchmark.py --scales small,medium --output bench_output.txt
+
+# sizes of the synthetic inputs at each scale
+SCALES = {
+    'small': {'seat_rows': 100, 'seat_cols': 100, 'tile_lines': 1_000, 'tile_line_length': 20},
+    'medium': {'seat_rows': 300, 'seat_cols': 300, 'tile_lines': 20_000, 'tile_line_length': 20},
+    'large': {'seat_rows': 1000, 'seat_cols': 1000, 'tile_lines': 1_000_000, 'tile_line_length': 20},
+}
+SCALE_ORDER = list(SCALES)
+
+COMPASS_DIRECTIONS = ['e', 'se', 'sw', 'w', 'nw', 'ne']
+
+
+def generate_seat_plan(num_rows, num_cols, floor_density=0.1, seed=0):
+    """
+    return a random seating plan as a list of rows (strings), with about floor_density of the cells floor (.) and the
+    rest empty seats (L)
+    """
+    rng = np.random.default_rng(seed)
+    cells = np.where(rng.random((num_rows, num_cols)) < floor_density, ord('.'), ord('L')).astype(np.uint8)
+    return [row.tobytes().decode() for row in cells]
+
+
+def generate_tile_instructions(num_lines, line_length, seed=0):
+    """
+    return num_lines random tile instructions (strings), each of line_length compass directions
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(0, len(COMPASS_DIRECTIONS), size=(num_lines, line_length))
+    return [''.join(COMPASS_DIRECTIONS[k] for k in line) for line in steps.tolist()]
+
+
+def half_occupied_plan(data, seed=0):
+    """return the bordered array of a seating plan with about half of the seats occupied, to benchmark one step"""
+    sp = day11.seat_plan_border_array(data)
+    rng = np.random.default_rng(seed)
+    seats = sp != 0
+    sp[seats & (rng.random(sp.shape) < 0.5)] = 1
+    return sp
+
+
+def heatmap_frame(sp):
+    """draw a seating plan the way run_sim1_saveImages does, into memory instead of a file"""
+    sns, plt = day11.plotting_modules()
+    plt.clf()
+    sns.heatmap(sp, cbar=False, xticklabels=False, yticklabels=False, cmap="magma_r")
+    plt.savefig(io.BytesIO(), format='png')
+
+
+def benchmark_cases(scale, work_dir, seed):
+    """
+    Return the benchmarks for a scale, as (name, function to time, largest scale to run it at). The inputs are
+    generated here, so they are not part of the timings.
+    """
+    params = SCALES[scale]
+    data = generate_seat_plan(params['seat_rows'], params['seat_cols'], seed=seed)
+    seat_file = os.path.join(work_dir, f'seat_plan_{scale}.txt')
+    with open(seat_file, 'w') as f:
+        f.write('\n'.join(data) + '\n')
+
+    instructions = generate_tile_instructions(params['tile_lines'], params['tile_line_length'], seed=seed)
+    tile_file = os.path.join(work_dir, f'tile_instructions_{scale}.txt')
+    with open(tile_file, 'w') as f:
+        f.write('\n'.join(instructions) + '\n')
+
+    sp = half_occupied_plan(data, seed)
+    seat_flat, sight_index = day11.build_sight_index(sp)
+    packed = day11.pack_seat_plan(sp)
+    double_buffered_step1 = day11.double_buffered_stepper(sp, 1)
+    double_buffered_step2 = day11.double_buffered_stepper(sp, 2)
+    colour_table = day11.state_colour_table()
+
+    tiles_dict = day24.load_tiles_dict(tile_file, num_workers=0)
+    tiles_dict_neighbs = day24.create_dict_neighbs(tiles_dict)
+    black_tiles = day24.black_tiles_set(tiles_dict)
+    grid, origin = day24.grow_dense_grid(*day24.tiles_dense_grid(tiles_dict))
+
+    cases = [
+        # parsing
+        ('day11.read_seat_plan+seat_plan_border_array',
+         lambda: day11.seat_plan_border_array(day11.read_seat_plan(seat_file)), 'large'),
+        ('day11.load_seat_plan', lambda: day11.load_seat_plan(seat_file), 'large'),
+        ('day24.read_tile_directions+flip_tiles_from_directions',
+         lambda: day24.flip_tiles_from_directions(day24.read_tile_directions(tile_file)), 'large'),
+        ('day24.load_tiles_dict', lambda: day24.load_tiles_dict(tile_file, num_workers=0), 'large'),
+        # one generation of the seating rules
+        ('day11.apply_rules_border_simultaneously', lambda: day11.apply_rules_border_simultaneously(sp), 'medium'),
+        ('day11.apply_rules_border_vectorised', lambda: day11.apply_rules_border_vectorised(sp), 'large'),
+        ('day11.apply_rules_packed', lambda: day11.apply_rules_packed(*packed[:2]), 'large'),
+        ('day11.apply_rules_border_diag_new', lambda: day11.apply_rules_border_diag_new(sp), 'small'),
+        ('day11.build_sight_index', lambda: day11.build_sight_index(sp), 'large'),
+        ('day11.apply_rules_sight_index', lambda: day11.apply_rules_sight_index(sp, seat_flat, sight_index), 'large'),
+        ('day11.double_buffered_stepper(part=1)', double_buffered_step1, 'large'),
+        ('day11.double_buffered_stepper(part=2)', double_buffered_step2, 'large'),
+        # one generation of the hex tiles
+        ('day24.create_dict_neighbs+flip_tiles_simultaneously',
+         lambda: day24.flip_tiles_simultaneously(day24.create_dict_neighbs(tiles_dict_neighbs)), 'large'),
+        ('day24.flip_black_tiles', lambda: day24.flip_black_tiles(black_tiles), 'large'),
+        ('day24.flip_dense_grid', lambda: day24.flip_dense_grid(grid), 'large'),
+        # rendering one frame
+        ('day11.heatmap_frame', lambda: heatmap_frame(sp), 'medium'),
+        ('day11.render_frame', lambda: day11.render_frame(sp, colour_table), 'large'),
+    ]
+
+    # the compiled kernels, if numba is installed. They are run once here, so compiling them is not timed
+    kernels = numba_backend.kernels_module()
+    if kernels is not None:
+        numba_rules1, numba_rules2 = day11.numba_rules(sp, 1), day11.numba_rules(sp, 2)
+        numba_rules1(sp), numba_rules2(sp), kernels.flip_hex_grid(grid)
+        cases += [
+            ('day11.numba_rules(part=1)', lambda: numba_rules1(sp), 'large'),
+            ('day11.numba_rules(part=2)', lambda: numba_rules2(sp), 'large'),
+            ('day24.numba_kernels.flip_hex_grid', lambda: kernels.flip_hex_grid(grid), 'large'),
+        ]
+
+    return cases
+
+
+def time_benchmark(func, repeat):
+    """return the best and mean wall time of func over repeat runs, and its peak traced memory in bytes"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    # tracemalloc slows the run down, so the peak memory comes from a separate run
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), sum(times) / len(times), peak_memory
+
+
+def git_commit():
+    """return the commit the benchmarks are run on, or None outside a git repo"""
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def run_benchmarks(scales, repeat=3, seed=0, name_filter=None, out=sys.stdout):
+    """
+    run the benchmarks at each scale, writing a JSON line per benchmark to out as soon as it finishes
+    """
+    run_info = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scale in scales:
+            for name, func, max_scale in benchmark_cases(scale, work_dir, seed):
+                # the reference loops are far too slow at the larger scales
+                if SCALE_ORDER.index(scale) > SCALE_ORDER.index(max_scale):
+                    continue
+                if name_filter and name_filter not in name:
+                    continue
+
+                best, mean, peak_memory = time_benchmark(func, repeat)
+                result = {
+                    'benchmark': name,
+                    'scale': scale,
+                    'params': SCALES[scale],
+                    'seed': seed,
+                    'repeat': repeat,
+                    'best_seconds': best,
+                    'mean_seconds': mean,
+                    'peak_memory_bytes': peak_memory,
+                    **run_info,
+                }
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the seating plan and hex tile simulations.')
+    parser.add_argument('--scales', default='small,medium', help=f'comma separated scales from {", ".join(SCALES)}')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic inputs')
+    parser.add_argument('--filter', default=None, help='only run benchmarks with this in their name')
+    parser.add_argument('--output', default=None, help='file to append the JSON lines to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    scales = args.scales.split(',')
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error(f'unknown scale {scale!r}, choose from {", ".join(SCALES)}')
+
+    if args.output:
+        with open(args.output, 'a') as out:
+            run_benchmarks(scales, args.repeat, args.seed, args.filter, out)
+    else:
+        run_benchmarks(scales, args.repeat, args.seed, args.filter)
+
+
+if __name__ == '__main__':
+    main()
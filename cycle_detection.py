@@ -0,0 +1,158 @@
+import collections
+import numpy as np
+import instrumentation
+
+# State hashing shared by the seating plan (day 11) and hex tile (day 24) simulations.
+
+# Stopping when a simulation's record of changes repeats is not exact: different sets of changes can give the same
+# record, and a simulation that cycles may never stop. Instead, keep a hash of the whole state. Each occupied seat or
+# black tile (a position (a, b)) gets a random looking 64 bit key, and the hash of a state is the xor of the keys of its
+# positions (Zobrist hashing, see: https://en.wikipedia.org/wiki/Zobrist_hashing). When positions change, their keys
+# are xor-ed in or out, so updating the hash only costs as much as the changes. If a generation changes nothing the
+# simulation has reached a fixed point. If the hash matches an earlier generation's, the state is kept and compared to
+# the state one period later, so a cycle is only reported once it is certain. After that, any later generation can be
+# found by jumping along the cycle instead of simulating.
+
+# result of run_until_cycle: the last state and its generation, the period of the cycle it is on (1 for a fixed point,
+# None if no cycle was found), and the count returned by step for every generation from 1
+CycleRun = collections.namedtuple('CycleRun', ['state', 'generation', 'period', 'counts'])
+
+
+def mix64(z):
+    """returns uint64 values mixed with the splitmix64 finaliser, so similar values get unrelated keys"""
+    # wrapping around on overflow
+    with np.errstate(over='ignore'):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+
+    return z
+
+
+def position_keys(positions):
+    """
+    Returns the 64 bit key (uint64) of each (a, b) integer position, mixed with splitmix64 so there is no table of keys
+    and the positions do not need to be bounded
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    z = (positions[:, 0].astype(np.uint64) << np.uint64(32)) ^ (positions[:, 1].astype(np.uint64) & np.uint64(0xffffffff))
+    return mix64(z)
+
+
+def toggle_hash(state_hash, positions):
+    """returns the state hash with the positions added if they were not in the state, and removed if they were"""
+    return state_hash ^ int(np.bitwise_xor.reduce(position_keys(positions), initial=np.uint64(0)))
+
+
+def cycle_finder(state_hash, same_state, keep_state=None):
+    """
+    Returns find(generation, state_hash, state), to call with the hash of the state after every generation that changed
+    something, starting from the hash of the initial state. It returns the period of the cycle once it is confirmed,
+    and None until then. If the states are reused (e.g. double buffering), keep_state must return a copy of a state,
+    which is used to keep a possible cycle's state.
+    """
+    seen = {state_hash: 0}
+    candidate = None # (generation, state, period) of a possible cycle, waiting to be confirmed
+
+    def find(generation, state_hash, state):
+        nonlocal candidate
+        if (candidate is not None) and (generation == candidate[0] + candidate[2]):
+            if same_state(state, candidate[1]):
+                return candidate[2]
+            candidate = None # two different states with the same hash
+
+        if (candidate is None) and (state_hash in seen):
+            kept = state if keep_state is None else keep_state(state)
+            candidate = (generation, kept, generation - seen[state_hash])
+        seen[state_hash] = generation
+        return None
+
+    return find
+
+
+def iterate_until_cycle(state, step, same_state, positions, max_generations=None, keep_state=None,
+                        toggle=toggle_hash):
+    """
+    Generator version of run_until_cycle, which yields the (state, changed, count) of every generation as it is
+    simulated, e.g. to render them, and returns the CycleRun when it stops.
+    """
+    state_hash = toggle(0, positions)
+    find_cycle = cycle_finder(state_hash, same_state, keep_state)
+    counts = []
+    generation = 0
+
+    while (max_generations is None) or (generation < max_generations):
+        state, changed, count = step(state)
+        generation += 1
+        counts.append(count)
+        yield state, changed, count
+
+        # nothing changed, so every later generation is the same
+        if len(changed) == 0:
+            return CycleRun(state, generation, 1, counts)
+
+        hash_start = instrumentation.start_phase()
+        state_hash = toggle(state_hash, changed)
+        instrumentation.end_phase('hashing', hash_start)
+        period = find_cycle(generation, state_hash, state)
+        if period is not None:
+            return CycleRun(state, generation, period, counts)
+
+    return CycleRun(state, generation, None, counts)
+
+
+def run_until_cycle(state, step, same_state, positions, max_generations=None, keep_state=None, toggle=toggle_hash):
+    """
+    Run a simulation until it reaches a fixed point or a cycle, or max_generations. step(state) must return the next
+    state, the positions that changed, and a count to record for the generation. same_state compares two states
+    exactly, and positions are the positions in the initial state. If step reuses its states (e.g. double buffering),
+    keep_state must return a copy of a state, which is used to keep a possible cycle's state. States that are not
+    positions can be hashed some other way by passing toggle(state_hash, changed), which returns the hash updated with
+    a generation's changes (and the initial hash from 0 and positions). Returns a CycleRun.
+    """
+    generations = iterate_until_cycle(state, step, same_state, positions, max_generations, keep_state, toggle)
+    while True:
+        try:
+            next(generations)
+        except StopIteration as stop:
+            return stop.value
+
+
+def cycle_generation(run, generation):
+    """
+    returns the generation run has simulated that has the same state as generation (which can be any later one)
+    """
+    if generation <= run.generation:
+        return generation
+    if run.period is None:
+        raise ValueError(f'no cycle was found in {run.generation} generations, so cannot jump to generation {generation}')
+
+    # the last period generations repeat forever
+    return run.generation - ((run.generation - generation) % run.period)
+
+
+def count_at_generation(run, generation):
+    """returns the count recorded for any generation from 1, without simulating"""
+    return run.counts[cycle_generation(run, generation) - 1]
+
+
+def state_at_generation(run, generation, step):
+    """
+    returns the state at any generation from the last one run simulated, by stepping from its last state for less
+    than one period
+    """
+    if generation < run.generation:
+        raise ValueError(f'generation {generation} is before the last state kept ({run.generation})')
+
+    if generation == run.generation:
+        return run.state
+
+    # raises an error if there is no cycle to jump along
+    cycle_generation(run, generation)
+
+    state = run.state
+    for i in range((generation - run.generation) % run.period):
+        state, changed, count = step(state)
+
+    return state
@@ -1,7 +1,23 @@
+import argparse
+import collections
+import concurrent.futures
+import functools
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import queue
+import sys
+import tempfile
+import warnings
 import numpy as np
-import moviepy.video.io.ImageSequenceClip
-import seaborn as sns
-import matplotlib.pyplot as plt
+import cycle_detection
+import double_buffering
+import instrumentation
+import numba_backend
+import result_cache
+import simulation_runs
+import trajectory
 
 # Part one — task is to load and clean the seating plan, and run the "Game of Life" simulation until no more seats change state.
 # The rules are:
@@ -10,13 +26,21 @@ import matplotlib.pyplot as plt
 
 # I have decided to use numpy arrays to tackle this problem. This is not the most efficient method, however, I have decided to do this such that I can create heatmaps from the data, with the overall aim of creating videos of the simulations, so that we can see the "Game of Life" (see: https://en.wikipedia.org/wiki/Conway%27s_Game_of_Life)
 
-# use a context manager to read lines from text file
-with open('day11_input.txt', 'r') as f:
-    file_contents = f.read()
+# The simulations only run when the script is run, not when it is imported (e.g. by the benchmarks)
 
-# split by new line and remove any empty strings
-data = file_contents.split('\n')
-data = [row for row in data if row.split()]
+def read_seat_plan(file_path):
+    """
+    Read the seating plan file into a list of rows (strings), removing any empty lines.
+    """
+    # use a context manager to read lines from text file
+    with open(file_path, 'r') as f:
+        file_contents = f.read()
+
+    # split by new line and remove any empty strings
+    data = file_contents.split('\n')
+    data = [row for row in data if row.split()]
+
+    return data
 
 # data loaded and cleaned, now define functions and run the simulation
 
@@ -29,18 +53,118 @@ def seat_plan_border_array(data):
     num_cols = len(data[0])
     seat_plan_b = np.zeros((num_rows+2, num_cols+2), dtype=int)
 
-    # fill in the array. The floor is defined as 0, and an empty seat as -1. Later, filled seats will be 1.
+    # fill in the array. The floor is defined as 0, an empty seat as -1, and a filled seat (# in a plan part way
+    # through a simulation) as 1.
     for i in range(num_rows):
         seats_str = data[i]
         for j in range(num_cols):
             seat_floor = seats_str[j]
             if seat_floor == "L":
                 seat_plan_b[i+1,j+1] = int(-1)
+            elif seat_floor == "#":
+                seat_plan_b[i+1,j+1] = int(1)
             else:
                 seat_plan_b[i+1,j+1] = int(0)
 
     return seat_plan_b
 
+# For very large plans, reading the file into a list of strings and filling the array one character at a time dominates
+# the start up. load_seat_plan memory maps the file instead, views the bytes as a 2D uint8 array, and translates them
+# into the bordered array with a lookup table, so there is no python work per character or per line.
+
+# cell code for every possible byte. Anything other than L, . or # is marked as invalid
+INVALID_CELL = 2
+CELL_CODES = np.full(256, INVALID_CELL, dtype=int)
+CELL_CODES[ord('L')] = -1
+CELL_CODES[ord('.')] = 0
+CELL_CODES[ord('#')] = 1
+
+def find_ragged_row(lines, file_path):
+    """raise an error for the first row of lines (a list of bytes) that is not the same length as the first"""
+    for i, line in enumerate(lines):
+        if len(line) != len(lines[0]):
+            raise ValueError(f'{file_path}: row {i+1} has {len(line)} cells, but row 1 has {len(lines[0])}')
+
+    raise ValueError(f'{file_path}: could not split the seating plan into rows')
+
+def map_seat_plan(file_path):
+    """memory map a seating plan file (read only), raising a ValueError if it is empty"""
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f'{file_path}: the seating plan is empty')
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def seat_plan_cells(file_path, mm=None):
+    """
+    returns a 2D uint8 view of the cells (bytes) of a seating plan file, without the line breaks, raising a ValueError
+    if the rows are not all the same length. If the file is already mapped with map_seat_plan, the map can be passed
+    as mm.
+    """
+    # the map stays open until it is garbage collected, as the array views below hold on to it
+    if mm is None:
+        mm = map_seat_plan(file_path)
+
+    # ignore any line breaks at the end of the file
+    end = len(mm)
+    while end > 0 and mm[end-1] in b'\r\n':
+        end -= 1
+    if end == 0:
+        raise ValueError(f'{file_path}: the seating plan is empty')
+
+    # the first line break gives the width of every row, and how long the line breaks are (\n or \r\n)
+    num_cols = mm.find(b'\n', 0, end)
+    num_cols = end if num_cols == -1 else num_cols
+    line_break = b'\n'
+    if num_cols > 0 and mm[num_cols-1] == ord('\r'):
+        num_cols -= 1
+        line_break = b'\r\n'
+    stride = num_cols + len(line_break)
+    num_rows, remainder = divmod(end + len(line_break), stride)
+
+    buf = np.frombuffer(mm, dtype=np.uint8)
+    breaks = np.lib.stride_tricks.as_strided(buf[num_cols:], shape=(num_rows-1, len(line_break)), strides=(stride, 1))
+    if (remainder != 0) or (num_cols == 0) or (breaks != np.frombuffer(line_break, dtype=np.uint8)).any():
+        find_ragged_row(mm[:end].splitlines(), file_path)
+
+    # view the bytes as rows of cells, skipping the line breaks
+    return np.lib.stride_tricks.as_strided(buf, shape=(num_rows, num_cols), strides=(stride, 1))
+
+def invalid_cell_error(file_path, cells, i, j):
+    """returns the error for the unknown character in the cells of a seating plan file at bordered row i, column j"""
+    return ValueError(f'{file_path}: unknown character {chr(cells[i-1, j-1])!r} at row {i}, column {j}')
+
+def load_seat_plan(file_path, mm=None):
+    """
+    Load a seating plan file straight into a bordered numpy array (see seat_plan_border_array), with L as an empty
+    seat (-1), . as floor (0) and # as an occupied seat (1). Raises a ValueError if the rows are not all the same
+    length or there are any other characters. If the file is already mapped with map_seat_plan (e.g. to hash it as
+    well), the map can be passed as mm.
+    """
+    # translate the cells into the bordered array
+    cells = seat_plan_cells(file_path, mm)
+    num_rows, num_cols = cells.shape
+    seat_plan_b = np.zeros((num_rows+2, num_cols+2), dtype=int)
+    np.take(CELL_CODES, cells, out=seat_plan_b[1:-1, 1:-1], mode='clip')
+
+    if (seat_plan_b == INVALID_CELL).any():
+        raise invalid_cell_error(file_path, cells, *np.argwhere(seat_plan_b == INVALID_CELL)[0])
+
+    return seat_plan_b
+
+def seat_plan_array(data):
+    """
+    returns the bordered seating plan of data, which can be the list of rows from read_seat_plan, the path of a
+    seating plan file (read with load_seat_plan), a PackedSeatPlan (unpacked), or a bordered seating plan already
+    (returned as it is)
+    """
+    if isinstance(data, np.ndarray):
+        return data
+    if isinstance(data, PackedSeatPlan):
+        return unpack_seat_plan(*data)
+    if isinstance(data, (str, os.PathLike)):
+        return load_seat_plan(data)
+    return seat_plan_border_array(data)
+
 def apply_rules_border_simultaneously(sp):
     """
     Accepts array of seating plan with borders, applies the rules simultaneously, and return the updated seating plan with a record of seat changes.
@@ -82,6 +206,62 @@ def apply_rules_border_simultaneously(sp):
 
     return spu, seat_change_list, seat_change_stab
 
+def neighbour_occupied_counts(sp):
+    """
+    Count the occupied adjacent seats of every seat in the bordered seating plan (or 3D stack of them) at once, by
+    summing the eight shifted slices of the occupied mask. Returns an array the size of the plan without its border.
+    """
+    occ = (sp == 1).astype(np.int8)
+    rr = sp.shape[-2]-2
+    cc = sp.shape[-1]-2
+
+    counts = np.zeros(sp.shape[:-2] + (rr, cc), dtype=np.int8)
+    for di in range(3):
+        for dj in range(3):
+            if (di == 1) and (dj == 1): # the seat itself is not a neighbour
+                continue
+            counts += occ[..., di:di+rr, dj:dj+cc]
+
+    return counts
+
+def apply_rules_border_vectorised(sp):
+    """
+    Vectorised version of apply_rules_border_simultaneously. The neighbour counts for the whole plan come from shifted
+    slices, and the two rules are applied as boolean masks. Returns the same (spu, seat_change_list, seat_change_stab),
+    with the seat changes as an (n, 2) array (see seat_change_lists for a list).
+    """
+    phase_start = instrumentation.start_phase()
+    occs = neighbour_occupied_counts(sp)
+    seats = sp[1:-1, 1:-1]
+    phase_start = instrumentation.end_phase('neighbours', phase_start)
+
+    # if seat unoccupied and no adjs seats occupied -> occ, if seat occupied and 4 or more adjs occupied -> unocc
+    to_occ = (seats == -1) & (occs == 0)
+    to_unocc = (seats == 1) & (occs >= 4)
+
+    spu = np.array(sp)
+    spu[1:-1, 1:-1][to_occ] = 1
+    spu[1:-1, 1:-1][to_unocc] = -1
+
+    # record changes in the same (row-major, bordered) form as the loop version
+    changed = np.argwhere(to_occ | to_unocc) + 1
+    seat_change_stab = int(changed.sum())
+    instrumentation.end_phase('rules', phase_start)
+
+    return spu, changed, seat_change_stab
+
+# The numpy rules return the seat changes as an (n, 2) array, which is what cycle_detection, trajectory and
+# population_stats work with. Turning them into a list of [row, col] lists and back costs far more than the rules
+# themselves on large plans, so a list is only made for callers that need the loop versions' seat_change_list.
+
+def seat_change_lists(apply_rules):
+    """wrap an apply_rules function so it returns its seat changes as a list of [row, col] lists, as the loop versions"""
+    def apply_rules_listed(sp):
+        spu, seat_changes, seat_change_stab = apply_rules(sp)
+        return spu, np.asarray(seat_changes, dtype=np.int64).reshape(-1, 2).tolist(), seat_change_stab
+
+    return apply_rules_listed
+
 
 def count_occupied_seats(seating_plan):
     """Count number of occupied seats"""
@@ -97,32 +277,396 @@ def count_occupied_seats(seating_plan):
 
     return occ_count
 
-def run_simulation1(data):
+# Late in a simulation only a few seats change each iteration, and a seat can only change if it, or one of the seats it
+# looks at, changed in the last iteration. Stepping incrementally re-evaluates just those seats. Both simulations can be
+# run this way by describing the seats each seat looks at as an index of flat positions.
+# Each seat's state and number of occupied neighbours are kept in compact arrays, updated from the changes, so checking
+# a seat reads two bytes. Early on, when a large share of the plan changes every iteration, updating the counts seat by
+# seat costs more than counting them all again, so while more than sweep_fraction of the seats change, the next
+# iteration recounts every seat (with shifted slices for the adjacent seats) and evaluates them all.
+
+# flat position used for "no seat" in a neighbour index. It is the top left corner of the border, which is always floor,
+# so gathering from it never counts an occupied seat
+NO_SEAT = 0
+
+# the eight adjacent cells as (row step, column step)
+ADJACENT_DIRECTIONS = [(0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1)]
+
+def build_adjacent_index(sp):
     """
-    Run the simulation until no more seats change state (simulation has converged),
-    and return the final state of the seating plan with a record of seat changes (stab_list)
+    Build the adjacent seat index for a bordered seating plan, or a 3D stack of them. Returns the flat positions of all
+    the seats, and an (n_seats, 8) array of the flat positions of their adjacent seats (NO_SEAT where the adjacent cell
+    is floor).
     """
-    # transform data to numpy array
-    sp_current = seat_plan_border_array(data)
-    iteration = 0
-    stab_list = []
+    is_seat = sp != 0
+    seat_flat = np.flatnonzero(is_seat)
+    cc = sp.shape[-1]
+
+    adjacent_index = np.empty((seat_flat.size, len(ADJACENT_DIRECTIONS)), dtype=np.int64)
+    for k, (dr, dc) in enumerate(ADJACENT_DIRECTIONS):
+        adj_flat = seat_flat + dr*cc + dc
+        adjacent_index[:, k] = np.where(is_seat.ravel()[adj_flat], adj_flat, NO_SEAT)
+
+    return seat_flat, adjacent_index
+
+def adjacent_occupied_counts(sp, seat_flat):
+    """the number of occupied adjacent seats of each seat at the flat positions seat_flat, from shifted slices"""
+    counts = np.zeros(sp.shape, dtype=np.int8)
+    counts[1:-1, 1:-1] = neighbour_occupied_counts(sp)
+    return counts.ravel()[seat_flat]
+
+def frontier_rules(sp, seat_flat, neighb_index, leave_at, count_occupied=None, sweep_fraction=0.1):
+    """
+    Returns an apply_rules function that steps incrementally. Only the seats that changed in the last iteration, and the
+    seats that look at them, are re-evaluated. The results are identical to a full sweep, but the cost of an iteration
+    scales with the number of changes rather than the size of the plan. neighb_index must be symmetric (seat a looks at
+    seat b only if b looks at a), which is true of both the adjacent and line of sight indexes. count_occupied(sp)
+    returns the number of occupied seats each seat looks at, for the iterations after more than sweep_fraction of the
+    seats changed (default: a gather over neighb_index). The changes are written into a copy of sp made once, which is
+    returned every iteration, so the function must be called with the plan it returned last time, and a plan kept
+    between iterations must be copied. The seat changes are returned as an (n, 2) array, as
+    apply_rules_border_vectorised.
+    """
+    grid = np.array(sp)
+    grid_flat = grid.ravel()
+    num_seats = seat_flat.size
+
+    # the rows of the seats each seat looks at, one array per direction so they can be gathered and summed a
+    # direction at a time. Floor (NO_SEAT) maps to a spare last row, which is never occupied
+    seat_row = np.full(sp.size, num_seats, dtype=np.int64)
+    seat_row[seat_flat] = np.arange(num_seats)
+    neighb_rows = np.ascontiguousarray(seat_row[neighb_index.T])
+    seat_states = np.zeros(num_seats + 1, dtype=np.int8)
+    seat_states[:num_seats] = grid_flat[seat_flat]
+    occ_counts = np.zeros(num_seats + 1, dtype=np.int8)
+    marks = np.zeros(num_seats + 1, dtype=bool)
+
+    if count_occupied is None:
+        def count_occupied(sp):
+            occupied = (seat_states == 1).view(np.int8)
+            counts = occupied[neighb_rows[0]]
+            for rows in neighb_rows[1:]:
+                counts += occupied[rows]
+            return counts
+
+    # None when every seat is evaluated, with its occupied neighbours counted again (as on the first iteration)
+    frontier = None
+
+    def apply_rules(sp):
+        nonlocal frontier
+        phase_start = instrumentation.start_phase()
+        if frontier is None:
+            occ_counts[:num_seats] = count_occupied(grid)
+            st = seat_states[:num_seats]
+            occ_number = occ_counts[:num_seats]
+        else:
+            st = seat_states[frontier]
+            occ_number = occ_counts[frontier]
+        phase_start = instrumentation.end_phase('neighbours', phase_start)
+
+        # if seat unoccupied and no neighbouring seats occupied -> occ, if seat occupied and leave_at or more occupied -> unocc
+        flips = ((st == -1) & (occ_number == 0)) | ((st == 1) & (occ_number >= leave_at))
+
+        # a seat that changes goes from empty (-1) to occupied (1) or back. The frontier is sorted, so the changes are
+        # in the same row-major order as a full sweep
+        changed_rows = np.flatnonzero(flips) if frontier is None else frontier[flips]
+        new_states = -st[flips]
+        seat_states[changed_rows] = new_states
+        changed_flat = seat_flat[changed_rows]
+        grid_flat[changed_flat] = new_states
+        changed = np.column_stack(np.divmod(changed_flat, grid.shape[1]))
+        phase_start = instrumentation.end_phase('rules', phase_start)
+
+        if changed_rows.size > sweep_fraction * num_seats:
+            frontier = None
+        else:
+            # the seats that look at a changed seat (the seats it looks at, as the index is symmetric) see one more or
+            # one fewer occupied seat, and only they and the changed seats can change next iteration. They are marked
+            # in a reused array, which comes out sorted and without duplicates
+            dependents = neighb_rows[:, changed_rows]
+            np.add.at(occ_counts, dependents.ravel(), np.tile(new_states, len(neighb_rows)))
+            marks[changed_rows] = True
+            marks[dependents] = True
+            frontier = np.flatnonzero(marks[:num_seats])
+            marks[frontier] = False
+            marks[num_seats] = False
+        instrumentation.end_phase('frontier', phase_start)
+
+        return grid, changed, int(changed.sum())
+
+    return apply_rules
+
+def occupied_seat_count(sp):
+    """number of occupied seats, counted with numpy (count_occupied_seats is the loop version)"""
+    return np.count_nonzero(sp == 1)
+
+def seats_occupied(sp, positions):
+    """returns whether the seat at each (row, col) position is occupied"""
+    return sp[positions[:, 0], positions[:, 1]] == 1
+
+def occupied_seat_positions(sp):
+    """returns the (n, 2) (row, col) positions of the occupied seats"""
+    return np.argwhere(sp == 1)
+
+def run_observed(sp, apply_rules, observer=None, every=1, profiler=None, trajectory_path=None, keyframe_interval=16,
+                 stats=None, keep_state=None):
+    """
+    Run a seating plan simulation with simulation_runs.run_observed, and return the CycleRun. If an observer is passed,
+    it gets a record of every every-th generation, and the steps are profiled if a cProfile.Profile is passed as
+    profiler. If a trajectory_path is passed, the run is saved there (see trajectory.py), with the starting plan as the
+    base. If a dict is passed as stats, it is filled with the population statistics of the plan (see
+    population_stats.py), kept up to date every generation. If apply_rules reuses its plans (e.g. frontier_rules),
+    keep_state must return a copy of a plan.
+    """
+    return simulation_runs.run_observed(sp, apply_rules, np.array_equal, occupied_seat_positions, seats_occupied,
+                                        base=sp.astype(np.int8), shape=sp.shape, observer=observer, every=every,
+                                        profiler=profiler, trajectory_path=trajectory_path,
+                                        keyframe_interval=keyframe_interval, stats=stats,
+                                        population=occupied_seat_count, keep_state=keep_state)
+
+def seat_plan_from_trajectory(traj, generation):
+    """rebuild the seating plan at any generation of a run saved with a trajectory_path, without simulating"""
+    sp = np.where(traj.base != 0, -1, 0)
+    sp[trajectory.grid_at_generation(traj, generation)] = 1
+    return sp
+
+def trajectory_seat_plans(trajectory_path):
+    """yield the seating plan after every generation of a run saved with a trajectory_path, replaying the changes"""
+    traj = trajectory.load_trajectory(trajectory_path)
+    sp = seat_plan_from_trajectory(traj, 0)
+    for generation in range(1, traj.generations + 1):
+        # a seat that changes goes from empty (-1) to occupied (1) or back
+        changed = tuple(trajectory.generation_deltas(traj, generation).T)
+        sp[changed] = -sp[changed]
+        yield sp.copy()
+
+def run_simulation1(data, apply_rules=apply_rules_border_vectorised, incremental=False, observer=None, **run_options):
+    """
+    Run the simulation until no more seats change state (simulation has converged), or it is found to cycle,
+    and return the final state of the seating plan with a record of seat changes (stab_list).
+    apply_rules_border_simultaneously can be passed as apply_rules to run the original loop as a reference.
+    If incremental is True, apply_rules is ignored and the simulation is stepped incrementally (see frontier_rules).
+    If an observer is passed, it gets a record of every generation, if a trajectory_path is passed the run is saved
+    there, and if a dict is passed as stats it is kept up to date with the population statistics (see run_observed).
+    """
+    # transform data to numpy array (data can be anything seat_plan_array accepts)
+    sp_current = seat_plan_array(data)
+
+    if incremental:
+        seat_flat, adjacent_index = build_adjacent_index(sp_current)
+        count_occupied = functools.partial(adjacent_occupied_counts, seat_flat=seat_flat)
+        apply_rules = frontier_rules(sp_current, seat_flat, adjacent_index, leave_at=4, count_occupied=count_occupied)
+        run_options['keep_state'] = np.copy # the frontier rules write the changes into the same plan
+
+    # run the simulation until no more seats change state (or it cycles). The seat changes are exactly the occupied
+    # seats added or removed, so the apply_rules functions can be used as the step, and stab_list is the counts
+    sim_run = run_observed(sp_current, apply_rules, observer, **run_options)
+    stab_list = sim_run.counts
 
-    # run the simulation until no more seats change state
-    pre_seat_stab = 0
-    seat_stab = 1
-    while pre_seat_stab != seat_stab:
-        pre_seat_stab = seat_stab
-        sp_current, seat_change_list, seat_stab = apply_rules_border_simultaneously(sp_current)
-        stab_list.append(seat_stab)
+    return sim_run.state, stab_list
 
-    return sp_current, stab_list
+# For very large plans the -1/0/1 int array uses 8 bytes per cell. The packed form stores two bitmasks instead, one for
+# "is seat" and one for "occupied", as rows of 64-bit words (bit k of word w in row r is column 64*w + k). The rules can
+# then be applied to 64 cells at a time with shifts and bitwise adds.
 
-# now run the simulation until no seats more seats change state, and count the occupied seats
-sp_final_sim1, _ = run_simulation1(data)
+WORD_BITS = 64
 
-# count the number of occupied seats in the final state
-occ_seats_sim1 = count_occupied_seats(sp_final_sim1)
-print(f'Part one: after converging, there are {occ_seats_sim1} occuied seats.')
+# a seating plan in the packed form, with the number of columns of the bordered plan
+PackedSeatPlan = collections.namedtuple('PackedSeatPlan', ['seat_bits', 'occ_bits', 'num_cols'])
+
+# number of set bits in every possible byte, for counting bits in packed words
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def pack_bits(mask):
+    """pack a 2D boolean array into rows of uint64 words"""
+    rr, cc = mask.shape
+    n_words = -(-cc // WORD_BITS)
+    padded = np.zeros((rr, n_words*WORD_BITS), dtype=bool)
+    padded[:, :cc] = mask
+    return np.packbits(padded, axis=1, bitorder='little').view('<u8')
+
+def unpack_bits(words, num_cols):
+    """unpack rows of uint64 words back into a 2D boolean array with num_cols columns"""
+    bits = np.unpackbits(words.view(np.uint8), axis=1, count=num_cols, bitorder='little')
+    return bits.astype(bool)
+
+def pack_seat_plan(sp):
+    """
+    Convert a bordered -1/0/1 seating plan into the packed form. Returns a PackedSeatPlan.
+    """
+    return PackedSeatPlan(pack_bits(sp != 0), pack_bits(sp == 1), sp.shape[1])
+
+def unpack_seat_plan(seat_bits, occ_bits, num_cols):
+    """
+    Convert the packed form back into a bordered -1/0/1 seating plan, e.g. for count_occupied_seats or the heatmaps
+    """
+    sp = np.zeros((seat_bits.shape[0], num_cols), dtype=int)
+    sp[unpack_bits(seat_bits, num_cols)] = -1
+    sp[unpack_bits(occ_bits, num_cols)] = 1
+    return sp
+
+def seat_plan_packed(data):
+    """
+    Transform the seating plan straight from the list of strings into the packed form, with the same border and
+    seats as seat_plan_border_array, one row at a time so the full int array is never created.
+    """
+    num_rows = len(data)
+    num_cols = len(data[0]) + 2
+    n_words = -(-num_cols // WORD_BITS)
+    seat_bits = np.zeros((num_rows+2, n_words), dtype='<u8')
+    occ_bits = np.zeros_like(seat_bits)
+
+    row_mask = np.zeros((1, num_cols), dtype=bool)
+    for i in range(num_rows):
+        row = np.frombuffer(data[i].encode(), dtype=np.uint8)
+        row_mask[0, 1:-1] = row == ord('#')
+        occ_bits[i+1] = pack_bits(row_mask)[0]
+        row_mask[0, 1:-1] |= row == ord('L')
+        seat_bits[i+1] = pack_bits(row_mask)[0]
+
+    return PackedSeatPlan(seat_bits, occ_bits, num_cols)
+
+# number of cells of a seating plan file load_seat_plan_packed decodes at a time
+PACKED_LOAD_CELLS = 1 << 20
+
+def load_seat_plan_packed(file_path, mm=None):
+    """
+    Load a seating plan file straight into the packed form (as load_seat_plan, but returning a PackedSeatPlan). The
+    memory mapped file is decoded and packed a band of rows at a time, so the full int array is never created.
+    """
+    cells = seat_plan_cells(file_path, mm)
+    num_rows, num_cols = cells.shape
+    n_words = -(-(num_cols+2) // WORD_BITS)
+    seat_bits = np.zeros((num_rows+2, n_words), dtype='<u8')
+    occ_bits = np.zeros_like(seat_bits)
+
+    band_rows = max(1, PACKED_LOAD_CELLS // num_cols)
+    band_mask = np.zeros((band_rows, num_cols+2), dtype=bool)
+    for start in range(0, num_rows, band_rows):
+        band = cells[start:start+band_rows]
+        mask = band_mask[:len(band)]
+        is_occ = band == ord('#')
+        is_seat = is_occ | (band == ord('L'))
+        is_valid = is_seat | (band == ord('.'))
+        if not is_valid.all():
+            i, j = np.argwhere(~is_valid)[0]
+            raise invalid_cell_error(file_path, cells, start + i + 1, j + 1)
+
+        mask[:, 1:-1] = is_occ
+        occ_bits[start+1:start+1+len(band)] = pack_bits(mask)
+        mask[:, 1:-1] = is_seat
+        seat_bits[start+1:start+1+len(band)] = pack_bits(mask)
+
+    return PackedSeatPlan(seat_bits, occ_bits, num_cols+2)
+
+def count_bits(words):
+    """count the set bits in an array of packed words"""
+    return int(POPCOUNT_TABLE[words.view(np.uint8)].sum(dtype=np.int64))
+
+def shift_from_left(words):
+    """returns words where each cell holds the bit of the cell to its left"""
+    shifted = words << np.uint64(1)
+    shifted[:, 1:] |= words[:, :-1] >> np.uint64(WORD_BITS-1)
+    return shifted
+
+def shift_from_right(words):
+    """returns words where each cell holds the bit of the cell to its right"""
+    shifted = words >> np.uint64(1)
+    shifted[:, :-1] |= words[:, 1:] << np.uint64(WORD_BITS-1)
+    return shifted
+
+def count_at_least(bit_planes, k):
+    """
+    accepts the binary digits of a count (least significant first) as packed words, and returns a mask of the cells
+    whose count is at least k
+    """
+    greater = np.zeros_like(bit_planes[0])
+    equal = ~greater
+    for i in range(len(bit_planes)-1, -1, -1):
+        if (k >> i) & 1:
+            equal &= bit_planes[i]
+        else:
+            greater |= equal & bit_planes[i]
+            equal &= ~bit_planes[i]
+
+    return greater | equal
+
+def apply_rules_packed(seat_bits, occ_bits, leave_at=4):
+    """
+    Packed version of apply_rules_border_vectorised. The eight adjacent occupied masks are added together with a
+    bitwise ripple-carry adder into a 4 bit count per cell. Returns the updated occ_bits and the number of seats changed.
+    """
+    occ_l = shift_from_left(occ_bits)
+    occ_r = shift_from_right(occ_bits)
+
+    # four bit planes of the neighbour count, for all rows inside the border
+    count = [np.zeros_like(occ_bits[1:-1]) for _ in range(4)]
+    any_occ = np.zeros_like(occ_bits[1:-1])
+    for neighb in [occ_l[:-2], occ_bits[:-2], occ_r[:-2], occ_l[1:-1], occ_r[1:-1], occ_l[2:], occ_bits[2:], occ_r[2:]]:
+        any_occ |= neighb
+        carry = neighb
+        for plane in count:
+            next_carry = plane & carry
+            plane ^= carry
+            carry = next_carry
+
+    # if seat unoccupied and no adjs seats occupied -> occ, if seat occupied and leave_at or more adjs occupied -> unocc
+    occ = occ_bits[1:-1]
+    to_occ = seat_bits[1:-1] & ~occ & ~any_occ
+    to_unocc = occ & count_at_least(count, leave_at)
+
+    occ_new = np.array(occ_bits)
+    occ_new[1:-1] = (occ & ~to_unocc) | to_occ
+
+    return occ_new, count_bits(to_occ) + count_bits(to_unocc)
+
+# The packed plans are hashed a word at a time rather than a cell at a time (see cycle_detection.py), so the changes
+# of a generation never need unpacking into positions. Each word value at each (row, word index) gets its own key, 0
+# for an empty word, and a generation's changes are the (row, word index, old word, new word) of the words that differ.
+
+def word_keys(rows, word_cols, words):
+    """returns the 64 bit key (uint64) of each packed word value at (row, word index), 0 for an empty word"""
+    keys = cycle_detection.mix64(cycle_detection.position_keys(np.column_stack((rows, word_cols))) ^ words)
+    keys[words == 0] = 0
+    return keys
+
+def changed_words(old_words, new_words):
+    """returns the (n, 4) uint64 array of the (row, word index, old word, new word) of the words that differ"""
+    rows, word_cols = np.nonzero(old_words != new_words)
+    return np.column_stack((rows.astype(np.uint64), word_cols.astype(np.uint64), old_words[rows, word_cols],
+                            new_words[rows, word_cols]))
+
+def toggle_word_hash(state_hash, word_changes):
+    """returns the hash of a packed state updated with the (n, 4) word changes from changed_words"""
+    rows, word_cols, old_words, new_words = word_changes.T
+    keys = word_keys(rows, word_cols, old_words) ^ word_keys(rows, word_cols, new_words)
+    return state_hash ^ int(np.bitwise_xor.reduce(keys, initial=np.uint64(0)))
+
+def run_simulation1_packed(data, leave_at=4, max_generations=None):
+    """
+    Run the first simulation in the packed form until no seats change state, or it is found to cycle (see
+    cycle_detection.py), or for at most max_generations. Returns the final PackedSeatPlan, which unpack_seat_plan turns
+    back into the usual array, and the number of seats changed each iteration. data can be a PackedSeatPlan or anything
+    seat_plan_array accepts, but a list of rows or the path of a file is packed without creating the full int array.
+    """
+    if isinstance(data, PackedSeatPlan):
+        seat_bits, occ_bits, num_cols = data
+    elif isinstance(data, list):
+        seat_bits, occ_bits, num_cols = seat_plan_packed(data)
+    elif isinstance(data, (str, os.PathLike)):
+        seat_bits, occ_bits, num_cols = load_seat_plan_packed(data)
+    else:
+        seat_bits, occ_bits, num_cols = pack_seat_plan(seat_plan_array(data))
+
+    def step(occ_bits):
+        occ_new, changes = apply_rules_packed(seat_bits, occ_bits, leave_at)
+        return occ_new, changed_words(occ_bits, occ_new), changes
+
+    sim_run = cycle_detection.run_until_cycle(occ_bits, step, np.array_equal,
+                                              changed_words(np.zeros_like(occ_bits), occ_bits), max_generations,
+                                              toggle=toggle_word_hash)
+
+    return PackedSeatPlan(seat_bits, sim_run.state, num_cols), sim_run.counts
 
 
 
@@ -329,116 +873,881 @@ def apply_rules_border_diag_new(sp):
 
     return spu, seat_change_list, seat_change_stab
 
-def run_simulation2(data):
+# The seeing_* functions rescan past the floor for every seat in every iteration. But the floor never changes, so the
+# first seat seen in each direction is fixed for the whole simulation. Find it once, and store it as an index.
+
+# the eight directions as (row step, column step)
+SIGHT_DIRECTIONS = [(0, -1), (-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1)]
+
+def first_seat_seen(is_seat, dr, dc, sentinel):
     """
-    Run the simulation until no more seats change state (simulation has converged),
-    and return the final state of the seating plan with a record of seat changes (stab_list)
+    returns the flat position of the first seat seen from every cell in the direction (dr, dc), or sentinel if no seat
+    seen. Any leading dimensions of is_seat are treated as a stack of separate plans.
     """
-    # transform data to numpy array
-    sp_current = seat_plan_border_array(data)
-    iteration = 0
-    stab_list = []
+    rr, cc = is_seat.shape[-2:]
+    flat_pos = np.arange(is_seat.size).reshape(is_seat.shape)
+    seen = np.full(is_seat.shape, sentinel, dtype=np.int64)
+
+    # sweep against the direction of sight, so the cell one step along has always been resolved already:
+    # the first seat seen is that cell if it is a seat, otherwise whatever that cell sees
+    if dr != 0:
+        rows = range(rr-2, -1, -1) if dr == 1 else range(1, rr)
+        for r in rows:
+            src = slice(max(dc, 0), cc + min(dc, 0))
+            dst = slice(max(-dc, 0), cc + min(-dc, 0))
+            seen[..., r, dst] = np.where(is_seat[..., r+dr, src], flat_pos[..., r+dr, src], seen[..., r+dr, src])
+    else:
+        cols = range(cc-2, -1, -1) if dc == 1 else range(1, cc)
+        for c in cols:
+            seen[..., c] = np.where(is_seat[..., c+dc], flat_pos[..., c+dc], seen[..., c+dc])
+
+    return seen
+
+def build_sight_index(sp):
+    """
+    Build the line of sight index for a bordered seating plan, or a 3D stack of them. Returns the flat positions of all
+    the seats, and an (n_seats, 8) array of the flat positions of the first seat seen in each direction (NO_SEAT if no
+    seat is seen).
+    """
+    is_seat = sp != 0
+    seat_flat = np.flatnonzero(is_seat)
+
+    sight_index = np.empty((seat_flat.size, len(SIGHT_DIRECTIONS)), dtype=np.int64)
+    for k, (dr, dc) in enumerate(SIGHT_DIRECTIONS):
+        sight_index[:, k] = first_seat_seen(is_seat, dr, dc, NO_SEAT).ravel()[seat_flat]
+
+    return seat_flat, sight_index
+
+def apply_rules_sight_index(sp, seat_flat, sight_index):
+    """
+    Indexed version of apply_rules_border_diag_new. The occupied seats seen by every seat are a single gather-and-sum
+    over the line of sight index. Returns the same (spu, seat_change_list, seat_change_stab), with the seat changes as
+    an (n, 2) array (see seat_change_lists for a list).
+    """
+    phase_start = instrumentation.start_phase()
+    occ_flat = sp.ravel() == 1
+    occ_number = occ_flat[sight_index].sum(axis=1)
+    st = sp.ravel()[seat_flat]
+    phase_start = instrumentation.end_phase('neighbours', phase_start)
+
+    # if seat unoccupied and no seen seats occupied -> occ, if seat occupied and 5 or more seen occupied -> unocc
+    to_occ = (st == -1) & (occ_number == 0)
+    to_unocc = (st == 1) & (occ_number >= 5)
+
+    spu = np.array(sp)
+    spu.ravel()[seat_flat[to_occ]] = 1
+    spu.ravel()[seat_flat[to_unocc]] = -1
+
+    # seat_flat is sorted, so the changes are in the same row-major order as the loop version
+    changed = np.column_stack(np.divmod(seat_flat[to_occ | to_unocc], sp.shape[1]))
+    seat_change_stab = int(changed.sum())
+    instrumentation.end_phase('rules', phase_start)
+
+    return spu, changed, seat_change_stab
+
+def sight_index_rules(sp):
+    """
+    returns an apply_rules function for the second simulation, with the line of sight index built once for this plan
+    """
+    seat_flat, sight_index = build_sight_index(sp)
+    return functools.partial(apply_rules_sight_index, seat_flat=seat_flat, sight_index=sight_index)
 
-    # run the simulation until no more seats change state
-    pre_seat_stab = 0
-    seat_stab = 1
-    while pre_seat_stab != seat_stab:
-        pre_seat_stab = seat_stab
-        sp_current, seat_change_list, seat_stab = apply_rules_border_diag_new(sp_current)
-        stab_list.append(seat_stab)
+def run_simulation2(data, apply_rules=None, incremental=False, observer=None, **run_options):
+    """
+    Run the simulation until no more seats change state (simulation has converged), or it is found to cycle,
+    and return the final state of the seating plan with a record of seat changes (stab_list).
+    By default the line of sight index is built once and reused every iteration. apply_rules_border_diag_new can be
+    passed as apply_rules to run the original loop as a reference.
+    If incremental is True, apply_rules is ignored and the simulation is stepped incrementally (see frontier_rules).
+    If an observer is passed, it gets a record of every generation, if a trajectory_path is passed the run is saved
+    there, and if a dict is passed as stats it is kept up to date with the population statistics (see run_observed).
+    """
+    # transform data to numpy array (data can be anything seat_plan_array accepts)
+    sp_current = seat_plan_array(data)
+
+    if incremental:
+        apply_rules = frontier_rules(sp_current, *build_sight_index(sp_current), leave_at=5)
+        run_options['keep_state'] = np.copy # the frontier rules write the changes into the same plan
+    elif apply_rules is None:
+        apply_rules = sight_index_rules(sp_current)
+
+    # run the simulation until no more seats change state (or it cycles). The seat changes are exactly the occupied
+    # seats added or removed, so the apply_rules functions can be used as the step, and stab_list is the counts
+    sim_run = run_observed(sp_current, apply_rules, observer, **run_options)
+    stab_list = sim_run.counts
+
+    return sim_run.state, stab_list
+
+def seat_plan_at_generation(data, generation, part=1):
+    """
+    Return the seating plan after any number of generations of the first (part=1) or second (part=2) simulation. Once
+    the simulation reaches a fixed point or a cycle, the later generations are found by jumping along it.
+    """
+    sp = seat_plan_array(data)
+    if part == 1:
+        apply_rules = apply_rules_border_vectorised
+    elif part == 2:
+        apply_rules = sight_index_rules(sp)
+    else:
+        raise ValueError(f'part must be 1 or 2, not {part}')
+
+    sim_run = cycle_detection.run_until_cycle(sp, apply_rules, np.array_equal, np.argwhere(sp == 1), generation)
+    return cycle_detection.state_at_generation(sim_run, generation, apply_rules)
+
+# The first-visible-seat scans can also be compiled to native code with numba (see numba_kernels.py), when it is
+# installed. numba takes a while to import, so it is only imported when the numba rules are asked for (see
+# numba_backend.py), and without it the numpy rules are used instead.
+
+def numba_rules(sp, part=1):
+    """
+    returns an apply_rules function for the first (part=1) or second (part=2) simulation that runs the compiled numba
+    kernel, or the numpy rules (apply_rules_border_vectorised or the line of sight index) if numba is not installed
+    """
+    if part not in (1, 2):
+        raise ValueError(f'part must be 1 or 2, not {part}')
+
+    kernels = numba_backend.kernels_module()
+    if kernels is None:
+        warnings.warn('numba is not installed, using the numpy rules')
+        return apply_rules_border_vectorised if part == 1 else sight_index_rules(sp)
+
+    # part one only looks at the adjacent seats, part two as far as the first seat
+    leave_at, max_distance = (4, 1) if part == 1 else (5, 0)
+
+    def apply_rules(sp):
+        spu, changed = kernels.apply_seat_rules(sp, leave_at, max_distance)
+        changes = np.argwhere(changed)
+        return spu, changes, int(changes.sum())
+
+    return apply_rules
+
+# Each generation of the rules above allocates a new plan, its masks and a list of the changes. The double buffered
+# stepper steps between two preallocated plans instead, so stepping allocates no arrays (see double_buffering.py).
+# Both simulations gather the neighbours' states through the adjacent or line of sight index, so they share one kernel.
+
+def double_buffered_stepper(sp, part=1):
+    """
+    Returns a step function for the first (part=1) or second (part=2) simulation, starting from a copy of the bordered
+    seating plan sp. Each call to step() advances one generation, and returns the buffer holding the new plan and a view
+    of the change buffer with the flat positions of the seats that changed (in row-major order). Both are overwritten by
+    later steps, so copy them to keep them.
+    """
+    if part == 1:
+        seat_flat, neighb_index = build_adjacent_index(sp)
+        leave_at = 4
+    elif part == 2:
+        seat_flat, neighb_index = build_sight_index(sp)
+        leave_at = 5
+    else:
+        raise ValueError(f'part must be 1 or 2, not {part}')
+
+    # the two plans, and flat views of them
+    plans = [np.array(sp, dtype=np.int8) for k in range(2)]
+    buffers = [plan.ravel() for plan in plans]
+
+    n_seats = seat_flat.size
+    occupied = np.empty(sp.size, dtype=bool)
+    seen = np.empty(neighb_index.shape, dtype=bool)
+    occ_number = np.empty(n_seats, dtype=np.int8)
+    states = np.empty(n_seats, dtype=np.int8)
+    to_occ, to_unocc, scratch = (np.empty(n_seats, dtype=bool) for k in range(3))
+    changes = np.empty(n_seats + 1, dtype=np.int64)
+    compress_changes = double_buffering.compressor(n_seats)
+    current = 0
+
+    def step():
+        nonlocal current
+        sp_flat, spu_flat = buffers[current], buffers[1 - current]
+
+        # count the occupied seats each seat sees
+        np.equal(sp_flat, 1, out=occupied)
+        np.take(occupied, neighb_index, out=seen, mode='clip')
+        np.sum(seen.view(np.int8), axis=1, out=occ_number) # int8 like the counts, so the sum does not cast
+        np.take(sp_flat, seat_flat, out=states, mode='clip')
+
+        # if seat unoccupied and none seen occupied -> occ, if seat occupied and leave_at or more -> unocc
+        np.equal(states, -1, out=to_occ)
+        np.equal(occ_number, 0, out=scratch)
+        np.logical_and(to_occ, scratch, out=to_occ)
+        np.equal(states, 1, out=to_unocc)
+        np.greater_equal(occ_number, leave_at, out=scratch)
+        np.logical_and(to_unocc, scratch, out=to_unocc)
+
+        # write the new seat states into the other plan (its floor is the same in both)
+        np.logical_or(to_occ, to_unocc, out=scratch)
+        num_changed = compress_changes(scratch, seat_flat, changes)
+        np.copyto(states, 1, where=to_occ)
+        np.copyto(states, -1, where=to_unocc)
+        np.put(spu_flat, seat_flat, states, mode='clip')
+
+        current = 1 - current
+        return plans[current], changes[:num_changed]
+
+    return step
+
+
+def run_double_buffered(data, part=1, max_generations=None):
+    """
+    Run the first (part=1) or second (part=2) simulation with double_buffered_stepper until no seat changes, or it is
+    found to cycle (see cycle_detection.py), or for at most max_generations, and return the final plan and stab_list,
+    the same as run_simulation1 and run_simulation2. Hashing the changes allocates in proportion to the number of
+    changes, not the size of the plan.
+    """
+    sp = seat_plan_array(data)
+    stepper = double_buffered_stepper(sp, part)
+
+    # scratch for the (row, col) positions of the changes, which are hashed to find a cycle
+    positions = np.empty((sp.size, 2), dtype=np.int64)
+
+    def step(plan):
+        plan, changes = stepper()
+        num_changed = changes.size
+        np.divmod(changes, sp.shape[1], out=(positions[:num_changed, 0], positions[:num_changed, 1]))
+        return plan, positions[:num_changed], int(positions[:num_changed].sum())
+
+    # the plan buffers are overwritten every other generation, so a possible cycle's plan is copied
+    sim_run = cycle_detection.run_until_cycle(sp, step, np.array_equal, np.argwhere(sp == 1), max_generations,
+                                              keep_state=np.copy)
+
+    return sim_run.state.astype(sp.dtype), sim_run.counts
+
+# To evaluate many candidate seating plans, running them one at a time pays the python overhead for every plan and
+# every iteration. Instead, stack the plans into one 3D array and step them all together: the first simulation counts
+# the occupied neighbours with shifted slices of the whole stack (as apply_rules_border_vectorised), and the second
+# gathers them with the line of sight index, offset into the flattened stack. A plan is retired as soon as it converges
+# or cycles. The plans still running are kept in a stack of their own, which (with the index) is compacted only when a
+# plan retires, so each iteration only touches the plans still running.
 
-    return sp_current, stab_list
+def stack_seat_plans(plans):
+    """
+    Transform a list of seating plans (each anything seat_plan_array accepts) into bordered arrays, padded with floor
+    to the largest shape and stacked into one 3D array. Returns the stack and the bordered shape of each plan.
+    """
+    sps = [seat_plan_array(plan) for plan in plans]
+    shapes = [sp.shape for sp in sps]
+    num_rows = max(shape[0] for shape in shapes)
+    num_cols = max(shape[1] for shape in shapes)
 
-# now run the second simulation until no seats more seats change state, and count the occupied seats
-sp_final_sim2, _ = run_simulation2(data)
+    # padding with floor leaves both the adjacent and the line of sight neighbours unchanged
+    stack = np.zeros((len(sps), num_rows, num_cols), dtype=np.int8)
+    for k, sp in enumerate(sps):
+        stack[k, :sp.shape[0], :sp.shape[1]] = sp
 
-# count the number of occupied seats in the final state
-occ_seats_sim2 = count_occupied_seats(sp_final_sim2)
-print(f'Part two: after converging, there are {occ_seats_sim2} occuied seats.')
+    return stack, shapes
+
+def step_batch_adjacent(live, keys_grid):
+    """
+    Apply the rules of the first simulation to a stack of bordered seating plans in place. Returns the position of the
+    plan in the stack, and the state hash key (keys_grid[row, col]), of every seat that changed.
+    """
+    occ_number = neighbour_occupied_counts(live)
+    inner = live[:, 1:-1, 1:-1]
+    to_occ = (inner == -1) & (occ_number == 0)
+    to_unocc = (inner == 1) & (occ_number >= 4)
+    inner[to_occ] = 1
+    inner[to_unocc] = -1
+
+    plans, rows, cols = np.nonzero(to_occ | to_unocc)
+    return plans, keys_grid[rows + 1, cols + 1]
+
+def step_batch_sight(live, index):
+    """
+    Apply the rules of the second simulation to a stack of bordered seating plans in place, with the line of sight index
+    of the stack (see batch_sight_index). Returns the same as step_batch_adjacent.
+    """
+    live_flat = live.ravel()
+    st = live_flat[index['seat_flat']]
+    occ_flat = (live_flat == 1).view(np.int8)
+    occ_number = np.zeros(st.size, dtype=np.int8)
+    for seen in index['sight_rows']:
+        occ_number += occ_flat[seen]
+    to_occ = (st == -1) & (occ_number == 0)
+    to_unocc = (st == 1) & (occ_number >= 5)
+    live_flat[index['seat_flat'][to_occ]] = 1
+    live_flat[index['seat_flat'][to_unocc]] = -1
+
+    changed = np.flatnonzero(to_occ | to_unocc)
+    return index['seat_plan'][changed], index['seat_keys'][changed]
+
+def batch_sight_index(stack, keys_grid):
+    """
+    Build the line of sight index of a stack of bordered seating plans (see build_sight_index), with the position in the
+    stack and the state hash key of every seat. Every plan has its own border, so no seat looks into another plan. The
+    index is kept transposed, as sight_rows, so the seats seen can be gathered and summed a direction at a time.
+    """
+    seat_flat, sight_index = build_sight_index(stack)
+    plan_size = stack[0].size
+    seat_plan = seat_flat // plan_size
+
+    # no seat seen is the corner of the seat's own plan rather than of the first, so the whole index of a plan can be
+    # moved with it when the stack is compacted
+    np.copyto(sight_index, (seat_plan * plan_size)[:, None], where=sight_index == NO_SEAT)
+    return {'seat_flat': seat_flat, 'sight_rows': np.ascontiguousarray(sight_index.T), 'seat_plan': seat_plan,
+            'seat_keys': keys_grid.ravel()[seat_flat % plan_size]}
+
+def compact_batch_index(index, still_active, plan_size):
+    """
+    Leave the seats of the retired plans out of a batch_sight_index, and move the rest to the positions of their plans
+    in the compacted stack (the plans that are still_active, in order)
+    """
+    new_plan = np.cumsum(still_active) - 1
+    keep = still_active[index['seat_plan']]
+    seat_plan = index['seat_plan'][keep]
+    shift = (seat_plan - new_plan[seat_plan]) * plan_size
+    index['sight_rows'] = index['sight_rows'][:, keep]
+    index['sight_rows'] -= shift
+    index['seat_flat'] = index['seat_flat'][keep]
+    index['seat_flat'] -= shift
+    index['seat_plan'] = new_plan[seat_plan]
+    index['seat_keys'] = index['seat_keys'][keep]
+
+def run_simulation_batch(plans, part=1, max_generations=None):
+    """
+    Run the first (part=1) or second (part=2) simulation on a list of seating plans at once. Each plan stops after
+    the first iteration where none of its seats change, or once it is found to cycle (see cycle_detection.py), or
+    after max_generations. Returns the final seating plan, the number of iterations, the period (1 for a fixed point,
+    None if it was still running) and the number of occupied seats of each plan.
+    """
+    if part not in (1, 2):
+        raise ValueError(f'part must be 1 or 2, not {part}')
+
+    stack, shapes = stack_seat_plans(plans)
+    num_plans, num_rows, num_cols = stack.shape
+
+    # every plan has its own state hash, of the (row, col) positions of its occupied seats (see cycle_detection.py).
+    # The keys of the seats that change are xor-ed into the hashes of their plans
+    keys_grid = cycle_detection.position_keys(np.argwhere(np.ones((num_rows, num_cols)))).reshape(num_rows, num_cols)
+    hashes = np.zeros(num_plans, dtype=np.uint64)
+    occupied = np.nonzero(stack == 1)
+    np.bitwise_xor.at(hashes, occupied[0], keys_grid[occupied[1:]])
+    find_cycles = [cycle_detection.cycle_finder(int(plan_hash), np.array_equal, keep_state=np.copy)
+                   for plan_hash in hashes.tolist()]
+
+    if part == 1:
+        index = None
+        step = functools.partial(step_batch_adjacent, keys_grid=keys_grid)
+    else:
+        index = batch_sight_index(stack, keys_grid)
+        step = functools.partial(step_batch_sight, index=index)
+
+    iterations = np.zeros(num_plans, dtype=int)
+    periods = [None] * num_plans
+
+    # run until every plan has converged or cycled, or for max_generations. The plans still running (active) are the
+    # stack live, and have all run for the same number of iterations
+    active = np.arange(num_plans)
+    live = stack
+    generation = 0
+    while (active.size > 0) and ((max_generations is None) or (generation < max_generations)):
+        changed_plans, changed_keys = step(live)
+        generation += 1
+        iterations[active] = generation
+        np.bitwise_xor.at(hashes, changed_plans, changed_keys)
+
+        # retire the plans that have converged or cycled, and compact the live stack (and index) without them
+        still_active = np.bincount(changed_plans, minlength=active.size) > 0
+        for i, k in enumerate(active.tolist()):
+            if not still_active[i]:
+                periods[k] = 1
+            else:
+                periods[k] = find_cycles[k](generation, int(hashes[i]), live[i])
+                still_active[i] = periods[k] is None
+
+        if not still_active.all():
+            stack[active[~still_active]] = live[~still_active]
+            if index is not None:
+                compact_batch_index(index, still_active, num_rows * num_cols)
+            active, live, hashes = active[still_active], live[still_active], hashes[still_active]
+
+    # the plans stopped by max_generations
+    stack[active] = live
+
+    final_plans = [stack[k, :shape[0], :shape[1]].astype(int) for k, shape in enumerate(shapes)]
+    occ_counts = (stack == 1).sum(axis=(1, 2))
+
+    return final_plans, iterations, periods, occ_counts
+
+# For very large plans one core is the bottleneck, even with the vectorised rules. The parallel engine splits the rows
+# of the bordered plan into bands, one task per band, run by a pool of worker processes. The plan lives in shared memory
+# as two buffers: each iteration every worker reads its band, plus the halo rows either side, from the current buffer
+# and writes its band into the other one, then the buffers swap roles. In line of sight mode a seat can see across any
+# number of bands, so instead of halos the workers share the precomputed line of sight index of the whole plan.
+
+# the shared arrays attached by each worker process
+band_worker_arrays = {}
+
+# The pools start their workers with spawn rather than the default fork on linux. After a numba run the process has
+# numba's worker threads, and forking a process with threads can leave a lock held in the child, which hangs the pool.
+POOL_CONTEXT = multiprocessing.get_context('spawn')
+
+def create_shared_array(shape, dtype):
+    """create a numpy array backed by a new block of shared memory. Returns the block and the array."""
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def init_band_worker(array_specs):
+    """pool initializer, attaches the shared arrays described by array_specs ({key: (name, shape, dtype)})"""
+    for key, (name, shape, dtype) in array_specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        band_worker_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # keep the block open for as long as the worker uses the array
+        band_worker_arrays[key + '_shm'] = shm
+
+def step_band(task):
+    """
+    Apply the rules to rows r0:r1 of the current buffer, writing the result into the other buffer.
+    Returns the band's part of seat_change_stab and the (n, 2) positions of the seats changed.
+    """
+    r0, r1, seat_rows, leave_at, current = task
+    grids = band_worker_arrays['grids']
+    sp, spu = grids[current], grids[1-current]
+    spu[r0:r1] = sp[r0:r1]
+
+    if seat_rows is None: # adjacent rules, with one halo row either side of the band
+        occs = neighbour_occupied_counts(sp[r0-1:r1+1])
+        seats = sp[r0:r1, 1:-1]
+        to_occ = (seats == -1) & (occs == 0)
+        to_unocc = (seats == 1) & (occs >= leave_at)
+        spu[r0:r1, 1:-1][to_occ] = 1
+        spu[r0:r1, 1:-1][to_unocc] = -1
+        rows, cols = np.nonzero(to_occ | to_unocc)
+        rows, cols = rows + r0, cols + 1
+    else: # line of sight rules, using the band's rows of the shared index
+        seat_flat = band_worker_arrays['seat_flat'][seat_rows[0]:seat_rows[1]]
+        sight_index = band_worker_arrays['sight_index'][seat_rows[0]:seat_rows[1]]
+        sp_flat = sp.ravel()
+        st = sp_flat[seat_flat]
+        occ_number = (sp_flat[sight_index] == 1).sum(axis=1)
+        to_occ = seat_flat[(st == -1) & (occ_number == 0)]
+        to_unocc = seat_flat[(st == 1) & (occ_number >= leave_at)]
+        spu.ravel()[to_occ] = 1
+        spu.ravel()[to_unocc] = -1
+        rows, cols = np.divmod(np.sort(np.concatenate([to_occ, to_unocc])), sp.shape[1])
+
+    return int(rows.sum() + cols.sum()), np.column_stack((rows, cols))
+
+def run_simulation_parallel(sp, part=1, num_workers=None, max_generations=None):
+    """
+    Run the first (part=1) or second (part=2) simulation on a bordered seating plan (see seat_plan_border_array) with
+    a pool of num_workers processes (default: one per cpu), until no more seats change state, or it is found to cycle
+    (see cycle_detection.py), or for at most max_generations. Returns the final seating plan and the stab_list, as
+    run_simulation1/run_simulation2.
+    """
+    if part not in (1, 2):
+        raise ValueError(f'part must be 1 or 2, not {part}')
+    leave_at = 4 if part == 1 else 5
+    num_workers = num_workers or os.cpu_count()
+
+    # split the rows inside the border into one band per worker
+    bounds = np.linspace(1, sp.shape[0]-1, min(num_workers, sp.shape[0]-2) + 1).astype(int)
+    bands = [(int(r0), int(r1)) for r0, r1 in zip(bounds[:-1], bounds[1:]) if r1 > r0]
+
+    shared = []
+    try:
+        shm, grids = create_shared_array((2,) + sp.shape, np.int8)
+        shared.append(shm)
+        grids[0] = sp
+        grids[1] = sp
+        array_specs = {'grids': (shm.name, grids.shape, grids.dtype)}
+
+        band_seat_rows = [None] * len(bands)
+        if part == 2:
+            seat_flat, sight_index = build_sight_index(sp)
+            for key, arr in [('seat_flat', seat_flat), ('sight_index', sight_index)]:
+                shm, shared_arr = create_shared_array(arr.shape, arr.dtype)
+                shared.append(shm)
+                shared_arr[...] = arr
+                array_specs[key] = (shm.name, arr.shape, arr.dtype)
+            # seat_flat is sorted, so each band's seats are a contiguous block of rows of the index
+            band_seat_rows = [tuple(int(k) for k in np.searchsorted(seat_flat, [r0*sp.shape[1], r1*sp.shape[1]]))
+                              for r0, r1 in bands]
+
+        current = 0
+        with POOL_CONTEXT.Pool(len(bands), initializer=init_band_worker, initargs=(array_specs,)) as pool:
+
+            def step(sp_current):
+                nonlocal current
+                tasks = [(r0, r1, seat_rows, leave_at, current) for (r0, r1), seat_rows in zip(bands, band_seat_rows)]
+                # the results of all the bands are the global reduction for the convergence and cycle checks
+                band_results = pool.map(step_band, tasks)
+                current = 1 - current
+                changed = np.concatenate([band_changed for _, band_changed in band_results])
+                return grids[current], changed, sum(band_stab for band_stab, _ in band_results)
+
+            # the buffers are overwritten every other generation, so a possible cycle's plan is copied
+            sim_run = cycle_detection.run_until_cycle(grids[0], step, np.array_equal, np.argwhere(sp == 1),
+                                                      max_generations, keep_state=np.copy)
+
+        sp_final = sim_run.state.astype(sp.dtype)
+        stab_list = sim_run.counts
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+    return sp_final, stab_list
 
 
 # The simulation work, now this time let's run them again but saving out the heatmaps at each iteration, such that I can visualise them as videos
 
-# set the fig size
-sns.set(rc={'figure.figsize':(11,11)})
+# seaborn, matplotlib and moviepy take a long time to import, and are only needed to draw the simulations, so they are
+# imported by the functions that draw. Importing this module for the simulations alone stays fast.
 
-def run_sim1_saveImages(data, image_file_direct, file_name):
+@functools.lru_cache(maxsize=None)
+def plotting_modules():
+    """imports seaborn and pyplot the first time they are needed, sets the fig size, and returns (sns, plt)"""
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
+    # set the fig size
+    sns.set(rc={'figure.figsize':(11,11)})
+    return sns, plt
+
+def save_heatmap_images(seat_plans, image_file_direct, file_name):
     """
-    runs the first simulation, saving out each iteration as a heatmap, which can then be made into a video
+    saves out each seating plan (e.g. from simulation_states or trajectory_seat_plans) as a heatmap, which can then be
+    made into a video, and returns the number of images
     """
-    # refresh the original seating plan and transform to numpy array
-    sp_current = seat_plan_border_array(data)
-    iteration = 0
-    stab_list = []
+    sns, plt = plotting_modules()
 
-    # run the simulation until no more seats change state
-    pre_seat_stab = 0
-    seat_stab = 1
     iteration = 0
-    while pre_seat_stab!= seat_stab:
-        pre_seat_stab = seat_stab
-        sp_current, seat_change_list, seat_stab = apply_rules_border_simultaneously(sp_current)
-        stab_list.append(seat_stab)
+    for sp_current in seat_plans:
         iteration += 1
 
         # create the file name
         fig_file_name = image_file_direct + file_name + '_' + str(iteration) + '.png'
-        # plot and save the heatmap
+        # plot and save the heatmap, on a cleared figure so the old heatmaps are not kept
+        plt.clf()
         sns.heatmap(sp_current, cbar=False, xticklabels=False, yticklabels=False, cmap="magma_r")
         plt.savefig(fig_file_name)
 
     return iteration
 
+def run_sim1_saveImages(data, image_file_direct, file_name):
+    """
+    runs the first simulation, saving out each iteration as a heatmap, which can then be made into a video
+    """
+    return save_heatmap_images(simulation_states(data, 1), image_file_direct, file_name)
+
 def run_sim2_saveImages(data, image_file_direct, file_name):
     """
     runs the second simulation, saving out each iteration as a heatmap, which can then be made into a video
     """
-    # refresh the original seating plan and transform to numpy array
-    sp_current = seat_plan_border_array(data)
-    iteration = 0
-    stab_list = []
+    return save_heatmap_images(simulation_states(data, 2), image_file_direct, file_name)
+
+def write_sim_video(image_files, fps, full_file_save):
+    """create mp4 from series of heatmaps"""
+    import moviepy.video.io.ImageSequenceClip
+
+    clip = moviepy.video.io.ImageSequenceClip.ImageSequenceClip(image_files, fps=fps)
+    clip.write_videofile(full_file_save)
+
+# Drawing every iteration with seaborn, saving it as a png and reading the pngs back for the video is slow for long runs
+# and large plans. Instead, map the states straight to RGB with a lookup table of the colourmap, and stream the frames
+# into the video encoder. The encoder runs on a background thread, so the simulation and the encoding overlap.
+
+def state_colour_table(cmap="magma_r"):
+    """returns a (3, 3) uint8 table of the RGB colours of the states -1, 0 and 1 in the colourmap"""
+    import matplotlib
+
+    colours = matplotlib.colormaps[cmap](np.linspace(0, 1, 3))[:, :3]
+    return np.round(colours * 255).astype(np.uint8)
+
+def render_frame(sp, colour_table, downsample=1):
+    """
+    Map a seating plan to an RGB frame, keeping every downsample-th row and column for very large plans. The frame is
+    padded to even dimensions, which the video encoder needs.
+    """
+    cells = sp[::downsample, ::downsample]
+    rr, cc = cells.shape
+    frame = np.zeros((rr + rr % 2, cc + cc % 2, 3), dtype=np.uint8)
+    frame[:rr, :cc] = colour_table[cells + 1]
+    return frame
+
+def simulation_states(data, part, observer=None, max_generations=None, **observe_options):
+    """
+    Run the first (part=1) or second (part=2) simulation until it converges, or is found to cycle (the cycle is
+    yielded once), or for at most max_generations, yielding the seating plan after every iteration. If an observer is
+    passed, it gets a record of every generation, including the time the caller spends between iterations (e.g.
+    rendering, timed with instrumentation.start_phase/end_phase).
+    """
+    sp_current = seat_plan_array(data)
+    if part == 1:
+        apply_rules = apply_rules_border_vectorised
+    elif part == 2:
+        apply_rules = sight_index_rules(sp_current)
+    else:
+        raise ValueError(f'part must be 1 or 2, not {part}')
+
+    finish_record = None
+    if observer is not None:
+        apply_rules, finish_record = instrumentation.observed_step(apply_rules, observer, occupied_seat_count,
+                                                                    **observe_options)
+
+    try:
+        for sp_current, seat_change_list, seat_stab in cycle_detection.iterate_until_cycle(
+                sp_current, apply_rules, np.array_equal, np.argwhere(sp_current == 1), max_generations):
+            yield sp_current
+    finally:
+        if finish_record is not None:
+            finish_record()
+
+def encode_frames(frames, full_file_save, fps, size):
+    """background encoder, writes the frames from the queue to the video until it receives None"""
+    import moviepy.video.io.ffmpeg_writer
+
+    writer = moviepy.video.io.ffmpeg_writer.FFMPEG_VideoWriter(full_file_save, size, fps)
+    try:
+        frame = frames.get()
+        while frame is not None:
+            writer.write_frame(frame)
+            frame = frames.get()
+    finally:
+        writer.close()
+
+def put_frame(frames, frame, encoder):
+    """put a frame on the queue, waiting while it is full, unless the encoder has stopped (re-raises its error)"""
+    while True:
+        try:
+            frames.put(frame, timeout=0.1)
+            return
+        except queue.Full:
+            if encoder.done():
+                encoder.result()
+                raise RuntimeError('the video encoder stopped early')
+
+def stream_sim_video(data, part, full_file_save, fps=7, downsample=1, cmap="magma_r", max_queued_frames=16,
+                     observer=None, **observe_options):
+    """
+    Run the first (part=1) or second (part=2) simulation and stream every iteration straight into an mp4 (see
+    stream_video). If an observer is passed, it gets a record of every generation, with the rendering timed as a phase.
+    """
+    seat_plans = simulation_states(data, part, observer, **observe_options)
+    return stream_video(seat_plans, full_file_save, fps, downsample, cmap, max_queued_frames)
 
-    # run the simulation until no more seats change state
-    pre_seat_stab = 0
-    seat_stab = 1
+def stream_video(seat_plans, full_file_save, fps=7, downsample=1, cmap="magma_r", max_queued_frames=16):
+    """
+    Stream seating plans (e.g. from simulation_states or trajectory_seat_plans) straight into an mp4, without any
+    intermediate images. At most max_queued_frames frames wait for the encoder. Returns the number of iterations.
+    """
+    colour_table = state_colour_table(cmap)
+    frames = queue.Queue(maxsize=max_queued_frames)
     iteration = 0
-    while pre_seat_stab!= seat_stab:
-        pre_seat_stab = seat_stab
-        sp_current, seat_change_list, seat_stab = apply_rules_border_diag_new(sp_current)
-        stab_list.append(seat_stab)
-        iteration += 1
 
-        # create the file name
-        fig_file_name = image_file_direct + file_name + '_' + str(iteration) + '.png'
-        # plot and save the heatmap
-        sns.heatmap(sp_current, cbar=False, xticklabels=False, yticklabels=False, cmap="magma_r")
-        plt.savefig(fig_file_name)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        encoder = None
+        try:
+            for sp_current in seat_plans:
+                phase_start = instrumentation.start_phase()
+                frame = render_frame(sp_current, colour_table, downsample)
+                instrumentation.end_phase('rendering', phase_start)
+                if encoder is None: # the first frame gives the size of the video
+                    size = (frame.shape[1], frame.shape[0])
+                    encoder = executor.submit(encode_frames, frames, full_file_save, fps, size)
+                put_frame(frames, frame, encoder)
+                iteration += 1
+        finally:
+            if encoder is not None:
+                put_frame(frames, None, encoder)
+                encoder.result()
 
     return iteration
 
-def write_sim_video(image_files, fps, full_file_save):
-    """create mp4 from series of heatmaps"""
-    clip = moviepy.video.io.ImageSequenceClip.ImageSequenceClip(image_files, fps=fps)
-    clip.write_videofile(full_file_save)
+# The fallback still writes pngs, e.g. to keep the frames or for write_sim_video, but renders them with the lookup table
+# on a pool of processes instead of drawing seaborn heatmaps one at a time.
 
-# set directory and file names for saving images
-image_file_direct = '/Users/george.stanley/Documents/Content/adventCode_2020/day11_simulations_pngs_mp4s/'
-file_name1 = 'simulation1_magma'
-file_name2 = 'simulation2_magma'
+def save_frame_png(task):
+    """worker, renders a seating plan with the colour table and saves it as a png"""
+    import matplotlib.image
 
-# run both simulations, save the heatmaps from each iteration, and save the total iteration numbers
-sim1_iterations = run_sim1_saveImages(data, image_file_direct, file_name1)
-sim2_iterations = run_sim2_saveImages(data, image_file_direct, file_name2)
+    sp, colour_table, downsample, fig_file_name = task
+    matplotlib.image.imsave(fig_file_name, render_frame(sp, colour_table, downsample))
+    return fig_file_name
 
-# generate list of image names to make videos
-sim1_image_files = [image_file_direct + file_name1 + '_' + str(i) + '.png' for i in range(1,sim1_iterations+1)]
-sim2_image_files = [image_file_direct + file_name2 + '_' + str(i) + '.png' for i in range(1,sim2_iterations+1)]
+def save_sim_images_parallel(data, part, image_file_direct, file_name, downsample=1, cmap="magma_r", num_workers=None):
+    """
+    Run the first (part=1) or second (part=2) simulation, saving every iteration as a png (see save_images_parallel)
+    """
+    return save_images_parallel(simulation_states(data, part), image_file_direct, file_name, downsample, cmap,
+                                num_workers)
 
-# create full file paths and names for saving the videos
-full_file_video_save1 = image_file_direct + file_name1 + '.mp4'
-full_file_video_save2 = image_file_direct + file_name2 + '.mp4'
+def save_images_parallel(seat_plans, image_file_direct, file_name, downsample=1, cmap="magma_r", num_workers=None):
+    """
+    Save seating plans (e.g. from simulation_states or trajectory_seat_plans) as pngs named as in run_sim1_saveImages,
+    rendered on a pool of num_workers processes. Returns the list of image files, in order.
+    """
+    colour_table = state_colour_table(cmap)
+    tasks = (
+        (sp_current.astype(np.int8), colour_table, downsample, image_file_direct + file_name + '_' + str(k) + '.png')
+        for k, sp_current in enumerate(seat_plans, start=1)
+    )
+
+    with POOL_CONTEXT.Pool(num_workers) as pool:
+        image_files = list(pool.imap(save_frame_png, tasks, chunksize=4))
+
+    return image_files
+
+# Command line: run either or both simulations with a chosen engine, and optionally save videos of them, e.g.
+# python day11_seatingPlanSimulation.py day11_input.txt --part 2 --engine incremental --video-dir videos/
+
+# engines that can run each part
+ENGINES = {
+    1: ['vectorised', 'incremental', 'numba', 'packed', 'parallel', 'double-buffered', 'reference'],
+    2: ['vectorised', 'incremental', 'numba', 'parallel', 'double-buffered', 'reference'],
+}
 
-# choose fps and make the movies
-fps = 7
-write_sim_video(sim1_image_files, fps, full_file_video_save1)
-write_sim_video(sim2_image_files, fps, full_file_video_save2)
+# engines that do not step through cycle_detection, so cannot be observed or save a trajectory
+UNRECORDED_ENGINES = ['packed', 'parallel', 'double-buffered']
+
+def run_part(data, part, engine='vectorised', observer=None, trajectory_path=None, num_workers=None):
+    """
+    run the first (part=1) or second (part=2) simulation with an engine from ENGINES, and return the final seating plan
+    and the record of seat changes (stab_list, or the number of seats changed each iteration for the packed engine).
+    data can be anything seat_plan_array accepts, e.g. the path of the seating plan file to load it with
+    load_seat_plan. If a trajectory_path is passed the run is saved there, e.g. to render it with trajectory_seat_plans.
+    num_workers is the number of worker processes of the parallel engine (default: one per cpu).
+    """
+    if engine not in ENGINES[part]:
+        raise ValueError(f'engine {engine!r} cannot run part {part}, choose from {", ".join(ENGINES[part])}')
+    if ((observer is not None) or (trajectory_path is not None)) and (engine in UNRECORDED_ENGINES):
+        raise ValueError(f'the {engine} engine cannot be observed or save a trajectory')
+
+    # load the plan once, for the engines that need the bordered array (the packed engine packs a list of rows or a
+    # file itself)
+    if engine != 'packed':
+        data = seat_plan_array(data)
+
+    run_simulation = run_simulation1 if part == 1 else run_simulation2
+    if engine == 'vectorised':
+        sp_final, stab_list = run_simulation(data, observer=observer, trajectory_path=trajectory_path)
+    elif engine == 'incremental':
+        sp_final, stab_list = run_simulation(data, incremental=True, observer=observer, trajectory_path=trajectory_path)
+    elif engine == 'numba':
+        apply_rules = numba_rules(data, part)
+        sp_final, stab_list = run_simulation(data, apply_rules, observer=observer, trajectory_path=trajectory_path)
+    elif engine == 'reference':
+        apply_rules = apply_rules_border_simultaneously if part == 1 else apply_rules_border_diag_new
+        sp_final, stab_list = run_simulation(data, apply_rules, observer=observer, trajectory_path=trajectory_path)
+    elif engine == 'packed':
+        packed_plan, stab_list = run_simulation1_packed(data)
+        sp_final = unpack_seat_plan(*packed_plan)
+    elif engine == 'double-buffered':
+        sp_final, stab_list = run_double_buffered(data, part)
+    else:
+        sp_final, stab_list = run_simulation_parallel(data, part, num_workers)
+
+    return sp_final, stab_list
+
+# bump when a change to the rules or engines changes their results, so older cached results are not used
+RESULTS_VERSION = 1
+
+def cached_run_part(file_path, part, engine='vectorised', cache_dir='.simulation_cache', max_bytes=1 << 30,
+                    num_workers=None):
+    """
+    run_part on a seating plan file, with the result cached in cache_dir (see result_cache.py) under the hash of the
+    file, the part and engine, and RESULTS_VERSION (not num_workers, which does not change the result). Returns the
+    final seating plan and the stab_list.
+    """
+    # the file is mapped once, to hash it and, if the result is not cached, to load it
+    mm = map_seat_plan(file_path)
+    key = result_cache.cache_key(mm, puzzle='day11', part=part, engine=engine, version=RESULTS_VERSION)
+
+    def compute():
+        load = load_seat_plan_packed if engine == 'packed' else load_seat_plan
+        sp_final, stab_list = run_part(load(file_path, mm), part, engine, num_workers=num_workers)
+        return {'seat_plan': sp_final, 'stab_list': stab_list, 'iterations': len(stab_list)}
+
+    result = result_cache.cached(cache_dir, key, compute, max_bytes)
+    return result['seat_plan'], result['stab_list'].tolist()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the day 11 seating plan simulations.')
+    parser.add_argument('input', nargs='?', default='day11_input.txt', help='seating plan file')
+    parser.add_argument('--part', choices=['1', '2', 'both'], default='both')
+    parser.add_argument('--engine', choices=sorted(set(ENGINES[1]) | set(ENGINES[2])), default='vectorised')
+    parser.add_argument('--telemetry', help='file to write a JSON line per generation to (- for stdout)')
+    parser.add_argument('--video-dir', help='directory to stream an mp4 of each simulation to')
+    parser.add_argument('--heatmap-dir', help='directory to save seaborn heatmaps of each iteration, and mp4s of them')
+    parser.add_argument('--fps', type=int, default=7)
+    parser.add_argument('--trajectory-dir', help='directory to save the trajectory of each simulation in')
+    parser.add_argument('--cache-dir', help='directory to cache the results in, to skip simulating the same input again')
+    parser.add_argument('--cache-max-bytes', type=int, default=1 << 30)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes of the parallel engine (default: one per cpu)')
+    args = parser.parse_args(argv)
+
+    parts = [1, 2] if args.part == 'both' else [int(args.part)]
+    for part in parts:
+        if args.engine not in ENGINES[part]:
+            parser.error(f'engine {args.engine} cannot run part {part}')
+    if (args.telemetry or args.trajectory_dir) and (args.engine in UNRECORDED_ENGINES):
+        parser.error(f'the {args.engine} engine cannot be observed or save a trajectory')
+    if args.cache_dir and (args.telemetry or args.trajectory_dir or args.video_dir or args.heatmap_dir):
+        parser.error('a cached run cannot be observed, save a trajectory or be rendered')
+    if (args.workers is not None) and (args.engine != 'parallel'):
+        parser.error('--workers is only used by the parallel engine')
+    if (args.workers is not None) and (args.workers < 1):
+        parser.error('--workers must be at least 1')
+    try:
+        # the packed engine packs the file as it loads it, so the full int array is never created
+        data = load_seat_plan_packed(args.input) if args.engine == 'packed' else load_seat_plan(args.input)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # the videos are rendered from the trajectories, so the simulations only run once. Without a trajectory dir they
+    # are kept in a temporary one
+    render = args.video_dir or args.heatmap_dir
+    temp_dir = None
+    trajectory_dir = args.trajectory_dir
+    if render and (trajectory_dir is None) and (args.engine not in UNRECORDED_ENGINES):
+        temp_dir = tempfile.TemporaryDirectory()
+        trajectory_dir = temp_dir.name
+    trajectory_paths = {part: None if trajectory_dir is None else os.path.join(trajectory_dir, f'simulation{part}')
+                        for part in parts}
+
+    telemetry = None
+    if args.telemetry == '-':
+        telemetry = sys.stdout
+    elif args.telemetry:
+        telemetry = open(args.telemetry, 'w')
+    observer = instrumentation.jsonl_sink(telemetry) if telemetry else None
+
+    try:
+        for part in parts:
+            if args.cache_dir:
+                sp_final, _ = cached_run_part(args.input, part, args.engine, args.cache_dir, args.cache_max_bytes,
+                                              args.workers)
+            else:
+                sp_final, _ = run_part(data, part, args.engine, observer, trajectory_paths[part], args.workers)
+            occ_seats = occupied_seat_count(sp_final)
+            print(f'Part {"one" if part == 1 else "two"}: after converging, there are {occ_seats} occuied seats.')
+    finally:
+        if telemetry not in (None, sys.stdout):
+            telemetry.close()
+
+    try:
+        for part in parts:
+            file_name = f'simulation{part}_magma'
+
+            def seat_plans():
+                if trajectory_paths[part] is None: # the packed and parallel engines have to simulate again
+                    return simulation_states(data, part)
+                return trajectory_seat_plans(trajectory_paths[part])
+
+            if args.video_dir:
+                stream_video(seat_plans(), os.path.join(args.video_dir, file_name + '.mp4'), args.fps)
+
+            # the original pipeline, drawing each iteration with seaborn and making the video from the pngs
+            if args.heatmap_dir:
+                image_file_direct = os.path.join(args.heatmap_dir, '')
+                sim_iterations = save_heatmap_images(seat_plans(), image_file_direct, file_name)
+                image_files = [image_file_direct + file_name + '_' + str(i) + '.png'
+                               for i in range(1, sim_iterations + 1)]
+                write_sim_video(image_files, args.fps, image_file_direct + file_name + '.mp4')
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+if __name__ == '__main__':
+    main()
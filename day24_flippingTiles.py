@@ -1,3 +1,21 @@
+import argparse
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import operator
+import os
+import sys
+import warnings
+import numpy as np
+import cycle_detection
+import double_buffering
+import instrumentation
+import numba_backend
+import result_cache
+import simulation_runs
+import trajectory
+
 # Part one
 
 # We have a system of hexagonal tiles, all starting face up (white), with a black reverse side, and a central tile at (0,0). The task is to follow each set of instructions (east, south east, west etc) and flip the tile that you land on. Then at the end, count the number of black tiles. Remember, one tile can be flipped several times.
@@ -23,48 +41,155 @@ def comp_to_coords(comp_direct):
     return x, y
 
 
-# use a context manager to read lines from text file
-with open('day24_input.txt', 'r') as f:
-    file_contents = f.read()
-
-# split by new line and remove any empty strings
-directions = file_contents.split('\n')
-directions = [direct for direct in directions if direct.split()]
+def read_tile_directions(file_path):
+    """
+    read the file of instructions, and split each line into a list of compass directions
+    """
+    # use a context manager to read lines from text file
+    with open(file_path, 'r') as f:
+        file_contents = f.read()
 
-# iterate through the list and split each string into a list of instructions
-directs_l = []
-for direct in directions:
+    # split by new line and remove any empty strings
+    directions = file_contents.split('\n')
+    directions = [direct for direct in directions if direct.split()]
 
-    direct_sep = direct.replace('e', 'e,')
-    direct_sep = direct_sep.replace('w', 'w,')
-    direct_sep = direct_sep.rstrip(',').split(',')
+    # iterate through the list and split each string into a list of instructions
+    directs_l = []
+    for direct in directions:
 
-    directs_l.append(direct_sep)
+        direct_sep = direct.replace('e', 'e,')
+        direct_sep = direct_sep.replace('w', 'w,')
+        direct_sep = direct_sep.rstrip(',').split(',')
 
-# for each set of instructions, loop through the instructions, follow the coordinates (i.e. x+=this_x etc),
-# and if this coordinate is not a key in the dict, store it as a black tile (-1). If it is in the dict, flip it (*-1).
-# white = 1, black = -1, all start as white:
-tiles_dict = {}
-for tile_direct in directs_l:
-    x = 0
-    y = 0
-    for comp_direct in tile_direct:  # read the compass instructions and follow in cartesian coords
-        this_x, this_y = comp_to_coords(comp_direct)
-        x += this_x
-        y += this_y
+        directs_l.append(direct_sep)
 
-    if (x, y) not in tiles_dict:  # if land on new tile, create and make black -> -1
-        tiles_dict[x, y] = -1
-    else:  # flip
-        tiles_dict[x, y] = tiles_dict[x, y] * -1
+    return directs_l
 
-# count and print the number of black tiles
-black_tile_count = 0
-for tile in tiles_dict.values():
-    if tile == -1:
-        black_tile_count += 1
 
-print(f'There are {black_tile_count} black tiles')
+def flip_tiles_from_directions(directs_l):
+    """
+    follow each list of compass directions from the central tile, and flip the tile landed on. Returns the dict of
+    tiles landed on, white = 1, black = -1
+    """
+    # for each set of instructions, loop through the instructions, follow the coordinates (i.e. x+=this_x etc),
+    # and if this coordinate is not a key in the dict, store it as a black tile (-1). If it is in the dict, flip it (*-1).
+    # white = 1, black = -1, all start as white:
+    tiles_dict = {}
+    for tile_direct in directs_l:
+        x = 0
+        y = 0
+        for comp_direct in tile_direct:  # read the compass instructions and follow in cartesian coords
+            this_x, this_y = comp_to_coords(comp_direct)
+            x += this_x
+            y += this_y
+
+        if (x, y) not in tiles_dict:  # if land on new tile, create and make black -> -1
+            tiles_dict[x, y] = -1
+        else:  # flip
+            tiles_dict[x, y] = tiles_dict[x, y] * -1
+
+    return tiles_dict
+
+
+# For instruction files with millions of lines, the above is slow and keeps every list of instructions in memory.
+# Following the instructions is just a sum of direction vectors, so the final coord of a line only depends on how many
+# of each direction it has. The streaming ingest reads the file in chunks of whole lines, and works out the coords of
+# all the lines in a chunk at once with numpy: each e or w byte adds to x (1 if after n or s, otherwise 2), and each n
+# or s byte adds to y. The chunks are processed in a pool of processes, and a tile is black if it was landed on an odd
+# number of times, so the chunks are combined by xor-ing the flip parity of each tile.
+
+# the pool starts its workers with spawn rather than fork: forking a process with numba's worker threads can hang
+POOL_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def read_line_chunks(file_path, chunk_size=1 << 24):
+    """
+    read a file in chunks of about chunk_size bytes, split at line breaks, so every chunk holds whole lines
+    """
+    with open(file_path, 'rb') as f:
+        carry = b''
+        for block in iter(lambda: f.read(chunk_size), b''):
+            block = carry + block
+            last_line_end = block.rfind(b'\n') + 1
+            carry = block[last_line_end:]
+            if last_line_end:
+                yield block[:last_line_end]
+        if carry:
+            yield carry
+
+
+def chunk_tile_parity(chunk):
+    """
+    follow the instructions on every line of a chunk of bytes, and return the coords of the tiles landed on (xs, ys)
+    and whether each was landed on an odd number of times
+    """
+    b = np.frombuffer(chunk, dtype=np.uint8)
+    is_n, is_s = b == ord('n'), b == ord('s')
+    is_e, is_w = b == ord('e'), b == ord('w')
+    is_newline = b == ord('\n')
+
+    # n and s must always be followed by e or w, and there must be no other characters
+    is_ns = is_n | is_s
+    is_ew = is_e | is_w
+    followed_by_ew = np.zeros_like(is_ns)
+    followed_by_ew[:-1] = is_ew[1:]
+    is_space = (b == ord('\r')) | (b == ord(' '))
+    is_bad = (is_ns & ~followed_by_ew) | ~(is_ns | is_ew | is_newline | is_space)
+    if is_bad.any():
+        bad_line = int(is_newline[:np.argmax(is_bad)].sum())
+        raise ValueError(f'invalid tile instructions: {chunk.splitlines()[bad_line]!r}')
+
+    # e and w move 2 in x on their own, or 1 after n or s
+    after_ns = np.zeros_like(is_ns)
+    after_ns[1:] = is_ns[:-1]
+    dx = np.where(is_e, 2, 0) - np.where(is_w, 2, 0)
+    dx[after_ns & is_e] = 1
+    dx[after_ns & is_w] = -1
+    dy = is_n.astype(np.int64) - is_s
+
+    # sum the moves of each line, skipping empty lines as before
+    line_id = np.cumsum(is_newline) - is_newline
+    num_lines = int(line_id[-1]) + 1 if b.size else 0
+    xs = np.bincount(line_id, weights=dx, minlength=num_lines).astype(np.int64)
+    ys = np.bincount(line_id, weights=dy, minlength=num_lines).astype(np.int64)
+    has_instructions = np.bincount(line_id, weights=is_ew, minlength=num_lines) > 0
+
+    coords, landed = np.unique(np.column_stack([xs, ys])[has_instructions], axis=0, return_counts=True)
+    return coords[:, 0], coords[:, 1], landed % 2 == 1
+
+
+def load_tiles_dict(file_path, chunk_size=1 << 24, num_workers=None):
+    """
+    Stream the tile instructions file in chunks, processed by a pool of num_workers processes (default: one per cpu,
+    0 to process them in this process), and return the same tiles_dict as following the instructions one by one.
+    """
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    parity = {}
+
+    def combine(chunk_result):
+        xs, ys, odd = chunk_result
+        for tile_xy, tile_odd in zip(zip(xs.tolist(), ys.tolist()), odd.tolist()):
+            parity[tile_xy] = parity.get(tile_xy, False) ^ tile_odd
+
+    if num_workers == 0:
+        for chunk in read_line_chunks(file_path, chunk_size):
+            combine(chunk_tile_parity(chunk))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=POOL_CONTEXT) as executor:
+            # only read ahead a couple of chunks per worker, so the whole file is never in memory
+            max_pending = 2 * num_workers
+            pending = set()
+            for chunk in read_line_chunks(file_path, chunk_size):
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        combine(future.result())
+                pending.add(executor.submit(chunk_tile_parity, chunk))
+            for future in concurrent.futures.as_completed(pending):
+                combine(future.result())
+
+    # black (-1) if landed on an odd number of times, otherwise white (1)
+    return {tile_xy: -1 if tile_odd else 1 for tile_xy, tile_odd in parity.items()}
 
 
 # Part two is a game of life style simulation
@@ -135,20 +260,694 @@ def number_black_tiles(tiles_dict):
     return black_tile_count
 
 
-# now run the simulation x100 (store results in a list in case want to plot)
-numb_black_list = []
-for i in range(100):
+def run_dict_simulation(tiles_dict, generations=100):
+    """
+    run the simulation on the dict of tiles for a number of generations, and return the number of black tiles after
+    each generation (the original engine, kept as a reference)
+    """
+    numb_black_list = []
+    for i in range(generations):
+
+        # make dict with neighbours
+        tiles_dict = create_dict_neighbs(tiles_dict)
+
+        #  flip the tiles
+        tiles_dict = flip_tiles_simultaneously(tiles_dict)
+
+        # count the number blacks
+        numb_blacks = number_black_tiles(tiles_dict)
+
+        # store in list in case wish to visualise simulation later
+        numb_black_list.append(numb_blacks)
 
-    # make dict with neighbours
-    tiles_dict = create_dict_neighbs(tiles_dict)
+    return numb_black_list
 
-    #  flip the tiles
-    tiles_dict = flip_tiles_simultaneously(tiles_dict)
 
-    # count the number blacks
-    numb_blacks = number_black_tiles(tiles_dict)
+# The dict keeps every white tile that has ever been next to a black one, and they are all rescanned every generation.
+# But only black tiles matter: a white tile can only flip if it has black neighbours. So just keep the set of black
+# tiles, count how many black neighbours every tile has in one pass over the black tiles' neighbours, and apply the
+# rules to those counts. The cost of a generation then depends on the number of black tiles only.
 
-    # store in list in case wish to visualise simulation later
-    numb_black_list.append(numb_blacks)
+def black_tiles_set(tiles_dict):
+    """
+    return the set of coords of the black tiles (-1) in dict
+    """
+    return {tile_xy for tile_xy, tile_col in tiles_dict.items() if tile_col == -1}
 
-print(f'There are {numb_black_list[-1]} black tiles')
+
+def flip_black_tiles(black_tiles):
+    """
+    accepts the set of black tiles, and returns the set of black tiles after flipping all the tiles simultaneously
+    """
+    # count the black neighbours of every tile next to a black tile
+    phase_start = instrumentation.start_phase()
+    numb_blacks = collections.Counter()
+    for tile_xy in black_tiles:
+        numb_blacks.update(make_list_neighbours(tile_xy[0], tile_xy[1]))
+    phase_start = instrumentation.end_phase('neighbours', phase_start)
+
+    # black and 1 or 2 black neighbs stays black (0 or >2 -> white), white and 2 black neighbs -> black
+    black_tiles_new = {tile_xy for tile_xy, numb in numb_blacks.items()
+                       if (numb == 2) or (numb == 1 and tile_xy in black_tiles)}
+    instrumentation.end_phase('rules', phase_start)
+
+    return black_tiles_new
+
+
+def flip_black_tiles_step(black_tiles):
+    """
+    flip the tiles as flip_black_tiles, and also return the tiles that changed colour and the number of black tiles
+    (the step used by cycle_detection)
+    """
+    black_tiles_new = flip_black_tiles(black_tiles)
+    return black_tiles_new, list(black_tiles ^ black_tiles_new), len(black_tiles_new)
+
+
+def run_set_simulation(tiles_dict, generations=100, observer=None, every=1, profiler=None, trajectory_path=None,
+                       keyframe_interval=16, stats=None):
+    """
+    run the simulation on the set of black tiles for a number of generations, and return the number of black tiles
+    after each generation (same as run_dict_simulation). If the tiles reach a fixed point or a cycle, the simulation
+    stops and the rest of the counts are filled in from the cycle. If an observer is passed, it gets a record of
+    every every-th generation (see instrumentation.observed_step), and the steps are profiled if a cProfile.Profile is
+    passed as profiler. If a trajectory_path is passed, the run is saved there (see trajectory.py), and if a dict is
+    passed as stats it is kept up to date with the population statistics (see simulate_black_tiles).
+    """
+    sim_run = simulate_black_tiles(black_tiles_set(tiles_dict), generations, observer, every, profiler,
+                                   trajectory_path, keyframe_interval, stats)
+    return [cycle_detection.count_at_generation(sim_run, i) for i in range(1, generations + 1)]
+
+
+def tiles_black(black_tiles, positions):
+    """returns whether the tile at each (x, y) position is black"""
+    return [tile_xy in black_tiles for tile_xy in map(tuple, positions.tolist())]
+
+
+def simulate_black_tiles(black_tiles, generations=100, observer=None, every=1, profiler=None, trajectory_path=None,
+                         keyframe_interval=16, stats=None):
+    """
+    run the simulation on the set of black tiles as run_set_simulation, and return the cycle_detection.CycleRun. If a
+    dict is passed as stats, it is filled with the population statistics of the tiles (see population_stats.py), kept
+    up to date every generation, with the rows and cols keyed by the x and y coords.
+    """
+    return simulation_runs.run_observed(black_tiles, flip_black_tiles_step, operator.eq, list, tiles_black,
+                                        max_generations=generations, observer=observer, every=every,
+                                        profiler=profiler, trajectory_path=trajectory_path,
+                                        keyframe_interval=keyframe_interval, stats=stats, population=len)
+
+
+def black_tiles_from_trajectory(trajectory_path, generation):
+    """
+    return the set of black tiles at any generation of a run saved with a trajectory_path, without simulating
+    """
+    traj = trajectory.load_trajectory(trajectory_path)
+    return set(map(tuple, trajectory.positions_at_generation(traj, generation).tolist()))
+
+
+def black_tiles_at_generation(tiles_dict, generation):
+    """
+    return the set of black tiles after any number of generations, jumping along the cycle if the tiles reach one
+    """
+    black_tiles = black_tiles_set(tiles_dict)
+    sim_run = cycle_detection.run_until_cycle(black_tiles, flip_black_tiles_step, operator.eq, list(black_tiles),
+                                              generation)
+
+    return cycle_detection.state_at_generation(sim_run, generation, flip_black_tiles_step)
+
+
+# For long runs with many black tiles, a dense numpy grid beats any dict or set. The doubled x coords (where x + y is
+# always even) are converted to axial coords q = (x - y) / 2, r = y, so the tiles fit a plain 2D array grid[r, q] with
+# the six neighbours at (q +- 1, r), (q, r +- 1), (q + 1, r - 1) and (q - 1, r + 1). The black neighbour counts are
+# then the sum of six shifted copies of the grid. The grid grows only when black tiles get close to its edge.
+
+def tiles_dense_grid(tiles_dict, margin=8):
+    """
+    convert the dict of tiles to a dense grid of black tiles (uint8, 1 is black) in axial coords, with margin white
+    tiles around the black ones. Returns the grid and the axial coords (q, r) of grid[0, 0].
+    """
+    black_tiles = black_tiles_set(tiles_dict)
+    if black_tiles:
+        xy = np.array(sorted(black_tiles))
+    else:
+        xy = np.zeros((0, 2), dtype=int)
+    qs = (xy[:, 0] - xy[:, 1]) // 2
+    rs = xy[:, 1]
+
+    q0 = (qs.min() if qs.size else 0) - margin
+    r0 = (rs.min() if rs.size else 0) - margin
+    num_rows = (rs.max() - rs.min() + 1 if rs.size else 1) + 2*margin
+    num_cols = (qs.max() - qs.min() + 1 if qs.size else 1) + 2*margin
+
+    grid = np.zeros((num_rows, num_cols), dtype=np.uint8)
+    grid[rs - r0, qs - q0] = 1
+
+    return grid, (q0, r0)
+
+
+def dense_grid_black_tiles(grid, origin):
+    """
+    return the set of black tiles in the dense grid, in the doubled x coords used by tiles_dict
+    """
+    rs, qs = np.nonzero(grid)
+    qs = qs + origin[0]
+    rs = rs + origin[1]
+    return set(zip((2*qs + rs).tolist(), rs.tolist()))
+
+
+def grow_dense_grid(grid, origin, margin=8):
+    """
+    make sure there are no black tiles in the two outer rows and columns of the grid, so the next generation fits in it.
+    If there are, pad that side with max(margin, a quarter of the grid) white tiles. Returns the grid and its origin.
+    """
+    pad_rows = max(margin, grid.shape[0] // 4)
+    pad_cols = max(margin, grid.shape[1] // 4)
+    pad_width = (
+        (pad_rows if grid[:2].any() else 0, pad_rows if grid[-2:].any() else 0),
+        (pad_cols if grid[:, :2].any() else 0, pad_cols if grid[:, -2:].any() else 0),
+    )
+    if not any(any(side) for side in pad_width):
+        return grid, origin
+
+    grid = np.pad(grid, pad_width)
+    origin = (origin[0] - pad_width[1][0], origin[1] - pad_width[0][0])
+    return grid, origin
+
+
+def dense_black_neighbours(grid):
+    """
+    return the number of black neighbours of every tile in the dense grid (0 for the outer rows and columns)
+    """
+    numb_blacks = np.zeros(grid.shape, dtype=np.uint8)
+    numb_blacks[1:-1, 1:-1] = (
+        grid[1:-1, 2:] + grid[1:-1, :-2]   # (q +- 1, r)
+        + grid[2:, 1:-1] + grid[:-2, 1:-1] # (q, r +- 1)
+        + grid[:-2, 2:] + grid[2:, :-2]    # (q + 1, r - 1) and (q - 1, r + 1)
+    )
+    return numb_blacks
+
+
+def flip_dense_grid(grid):
+    """
+    flip all the tiles in the dense grid simultaneously and return the new grid. The outer rows and columns must be
+    white and not have any black neighbours (see grow_dense_grid).
+    """
+    numb_blacks = dense_black_neighbours(grid)
+
+    # black and 1 or 2 black neighbs stays black (0 or >2 -> white), white and 2 black neighbs -> black
+    return ((numb_blacks == 2) | ((grid == 1) & (numb_blacks == 1))).astype(np.uint8)
+
+
+def numba_flip_grid():
+    """
+    returns the compiled numba kernel for flipping the dense grid (see numba_kernels.py), or flip_dense_grid if numba is
+    not installed (see numba_backend.py).
+    """
+    kernels = numba_backend.kernels_module()
+    if kernels is None:
+        warnings.warn('numba is not installed, using flip_dense_grid')
+        return flip_dense_grid
+    return kernels.flip_hex_grid
+
+
+def run_dense_simulation(tiles_dict, generations=100, flip_grid=flip_dense_grid):
+    """
+    run the simulation on a dense grid for a number of generations, and return the number of black tiles after each
+    generation (same as run_dict_simulation). flip_grid can be the numba kernel (see numba_flip_grid).
+    """
+    grid, origin = tiles_dense_grid(tiles_dict)
+    numb_black_list = []
+    for i in range(generations):
+        grid, origin = grow_dense_grid(grid, origin)
+        grid = flip_grid(grid)
+        numb_black_list.append(int(grid.sum()))
+
+    return numb_black_list
+
+# The dense engine allocates a new grid, and the counts and masks, every generation. The double buffered stepper steps
+# between two preallocated grids instead, so stepping allocates no arrays (see double_buffering.py). Only a window of
+# the grids around the black tiles is stepped, which grows as they spread (like grow_dense_grid). The grids and scratch
+# arrays have room for half as much again as the window in each direction (at least two tiles on every side), and are
+# only reallocated, with the window moved to the middle, once the black tiles reach their edge. As the buffers grow
+# geometrically, that happens less and less often, and the memory stays in proportion to the area of the black tiles
+# however many generations are run.
+
+def double_buffered_tile_stepper(tiles_dict, report_changes=True):
+    """
+    Returns a step function for the dense grid simulation. Each call to step() advances one generation, and returns
+    the buffer holding the new grid, the axial coords of its [0, 0] (see tiles_dense_grid), a view of the change buffer
+    with the flat positions of the tiles flipped (in row-major order, or None if not report_changes, which saves a good
+    part of the step), and the number of black tiles. The grid and changes are overwritten by later steps, so copy them
+    to keep them. The grids move to bigger buffers when the tiles outgrow them, which changes the origin.
+    """
+    # the window stepped (rows r0:r1, cols c0:c1), starting with two white tiles around the black ones
+    grid, origin = tiles_dense_grid(tiles_dict, margin=2)
+    window = [0, grid.shape[0], 0, grid.shape[1]]
+    population = int(grid.sum())
+
+    # the two grids and the scratch arrays, replaced when the tiles outgrow them
+    buffers = {'grids': [grid], 'current': 0, 'origin': origin}
+
+    def reallocate():
+        """move the window of the current grid to the middle of new buffers half as big again, and new scratch arrays"""
+        r0, r1, c0, c1 = window
+        num_rows, num_cols = (r1 - r0) + max(4, (r1 - r0) // 2), (c1 - c0) + max(4, (c1 - c0) // 2)
+        dr, dc = (num_rows - (r1 - r0)) // 2 - r0, (num_cols - (c1 - c0)) // 2 - c0
+        grids = [np.zeros((num_rows, num_cols), dtype=np.uint8) for k in range(2)]
+        grids[0][r0 + dr:r1 + dr, c0 + dc:c1 + dc] = buffers['grids'][buffers['current']][r0:r1, c0:c1]
+        window[:] = [r0 + dr, r1 + dr, c0 + dc, c1 + dc]
+        origin = buffers['origin']
+        buffers.update(grids=grids, current=0, origin=(origin[0] - dc, origin[1] - dr))
+
+        # scratch for the largest window, of which the first h*w elements are used as an h x w array
+        capacity = (num_rows - 2) * (num_cols - 2)
+        buffers['numb_blacks'] = np.empty(capacity, dtype=np.uint8)
+        for name in ('black', 'new_black', 'flipped'):
+            buffers[name] = np.empty(capacity, dtype=bool)
+        if report_changes:
+            buffers['window_positions'] = np.arange(capacity)
+            buffers['rows'], buffers['cols'] = np.empty(capacity, dtype=np.int64), np.empty(capacity, dtype=np.int64)
+            buffers['changes'] = np.empty(capacity + 1, dtype=np.int64)
+            buffers['compress_changes'] = double_buffering.compressor(capacity)
+
+    reallocate()
+
+    def grow_window():
+        """make sure there are no black tiles in the two outer rows and columns of the window, as grow_dense_grid"""
+        g = buffers['grids'][buffers['current']]
+        r0, r1, c0, c1 = window
+        top, bottom = np.count_nonzero(g[r0:r0 + 2, c0:c1]) > 0, np.count_nonzero(g[r1 - 2:r1, c0:c1]) > 0
+        left, right = np.count_nonzero(g[r0:r1, c0:c0 + 2]) > 0, np.count_nonzero(g[r0:r1, c1 - 2:c1]) > 0
+
+        # the window can only grow by two or more tiles on a side while it is that far from the edge of the grid
+        num_rows, num_cols = g.shape
+        if (top and r0 < 2) or (bottom and r1 > num_rows - 2) or (left and c0 < 2) or (right and c1 > num_cols - 2):
+            reallocate()
+            r0, r1, c0, c1 = window
+            num_rows, num_cols = buffers['grids'][0].shape
+
+        pad_rows = max(8, (r1 - r0) // 4)
+        pad_cols = max(8, (c1 - c0) // 4)
+        if top:
+            window[0] = max(r0 - pad_rows, 0)
+        if bottom:
+            window[1] = min(r1 + pad_rows, num_rows)
+        if left:
+            window[2] = max(c0 - pad_cols, 0)
+        if right:
+            window[3] = min(c1 + pad_cols, num_cols)
+
+    def step():
+        nonlocal population
+        grow_window()
+        grids, current = buffers['grids'], buffers['current']
+        r0, r1, c0, c1 = window
+        g = grids[current][r0:r1, c0:c1]
+        tiles_new = grids[1 - current][r0 + 1:r1 - 1, c0 + 1:c1 - 1]
+        h, w = r1 - r0 - 2, c1 - c0 - 2
+        numb_blacks = buffers['numb_blacks'][:h*w].reshape(h, w)
+        black = buffers['black'][:h*w].reshape(h, w)
+        new_black = buffers['new_black'][:h*w].reshape(h, w)
+        flipped = buffers['flipped'][:h*w].reshape(h, w)
+
+        # (q +- 1, r), (q, r +- 1), (q + 1, r - 1) and (q - 1, r + 1)
+        np.add(g[1:-1, 2:], g[1:-1, :-2], out=numb_blacks)
+        for neighb in (g[2:, 1:-1], g[:-2, 1:-1], g[:-2, 2:], g[2:, :-2]):
+            np.add(numb_blacks, neighb, out=numb_blacks)
+
+        # black and 1 or 2 black neighbs stays black (0 or >2 -> white), white and 2 black neighbs -> black
+        np.equal(g[1:-1, 1:-1], 1, out=black)
+        np.equal(numb_blacks, 1, out=flipped)
+        np.logical_and(flipped, black, out=flipped)
+        np.equal(numb_blacks, 2, out=new_black)
+        np.logical_or(new_black, flipped, out=new_black)
+        np.copyto(tiles_new, new_black.view(np.uint8)) # uint8 like the grid, so the copy does not cast
+
+        # how many tiles flipped and how many turned black
+        np.not_equal(new_black, black, out=flipped)
+        num_flipped = np.count_nonzero(flipped)
+        np.logical_and(flipped, new_black, out=black)
+        population += 2*np.count_nonzero(black) - num_flipped
+
+        # the flipped tiles, as positions in the window and then in the grid
+        changes = None
+        if report_changes:
+            num_cols = grids[0].shape[1]
+            rows, cols = buffers['rows'][:num_flipped], buffers['cols'][:num_flipped]
+            changes = buffers['changes']
+            buffers['compress_changes'](buffers['flipped'][:h*w], buffers['window_positions'][:h*w], changes)
+            changes = changes[:num_flipped]
+            np.divmod(changes, w, out=(rows, cols))
+            np.multiply(rows, num_cols, out=rows)
+            np.add(rows, cols, out=changes)
+            np.add(changes, (r0 + 1)*num_cols + c0 + 1, out=changes)
+
+        buffers['current'] = 1 - current
+        return grids[1 - current], buffers['origin'], changes, population
+
+    return step
+
+
+def run_double_buffered_tiles(tiles_dict, generations=100):
+    """
+    run the simulation with double_buffered_tile_stepper for a number of generations, and return the number of black
+    tiles after each generation (same as run_dict_simulation)
+    """
+    step = double_buffered_tile_stepper(tiles_dict, report_changes=False)
+    numb_black_list = []
+    for i in range(generations):
+        grid, origin, changes, population = step()
+        numb_black_list.append(population)
+
+    return numb_black_list
+
+
+# To study the pattern over millions of generations, any engine that steps one generation at a time is too slow.
+# Hashlife (see: https://en.wikipedia.org/wiki/Hashlife) stores the tiles in a quadtree over the axial coords, where
+# identical blocks are the same node, and memoises the future of each block. A block of 2^k x 2^k tiles determines
+# its centre 2^(k-2) generations ahead, because nothing moves faster than one tile per generation, and in axial coords
+# the six neighbours are all within one row and one column. Repeated blocks are then only ever worked out once, so
+# the engine can jump 2^k generations in one step.
+# That only pays off for patterns that repeat in space and time, e.g. ones that settle into still or periodic blocks.
+# The puzzle's tiles keep growing into new, irregular blocks, so almost every block is new and all the time goes on
+# building and memoising nodes: 300 generations of the puzzle input take about 10s, against 0.05s for the dense engine.
+# So it is not one of the command line ENGINES, but hashlife_black_count and run_engine(..., engine='hashlife') can
+# still jump far ahead on periodic patterns.
+
+# maximum number of quadtree nodes and block futures kept by each cache. Beyond this the least recently used are evicted
+HASHLIFE_CACHE_SIZE = 1 << 20
+
+
+class HexNode(collections.namedtuple('HexNode', ['level', 'nw', 'ne', 'sw', 'se', 'population', 'node_hash'])):
+    """
+    quadtree node of 2^level x 2^level tiles, made of four 2^(level-1) quadrants (None for single tiles)
+    """
+    __slots__ = ()
+
+    def __hash__(self):
+        return self.node_hash
+
+
+BLACK_TILE = HexNode(0, None, None, None, None, 1, 1)
+WHITE_TILE = HexNode(0, None, None, None, None, 0, 0)
+
+
+@functools.lru_cache(maxsize=HASHLIFE_CACHE_SIZE)
+def join_nodes(nw, ne, sw, se):
+    """
+    return the canonical node made of four quadrants
+    """
+    node_hash = hash((nw.level, nw.node_hash, ne.node_hash, sw.node_hash, se.node_hash))
+    population = nw.population + ne.population + sw.population + se.population
+    return HexNode(nw.level + 1, nw, ne, sw, se, population, node_hash)
+
+
+@functools.lru_cache(maxsize=64)
+def white_node(level):
+    """
+    return the node of 2^level x 2^level white tiles
+    """
+    if level == 0:
+        return WHITE_TILE
+    white = white_node(level - 1)
+    return join_nodes(white, white, white, white)
+
+
+def centre_node(node):
+    """
+    return the node one level up with node in its centre
+    """
+    white = white_node(node.level - 1)
+    return join_nodes(
+        join_nodes(white, white, white, node.nw), join_nodes(white, white, node.ne, white),
+        join_nodes(white, node.sw, white, white), join_nodes(node.se, white, white, white),
+    )
+
+
+# The 4 x 4 base case is the only place the rules are applied, and it is reached for every new block. Instead of
+# reading its 16 tiles one at a time, every 2 x 2 node gets a 4 bit code (a bit per tile), so the four quadrants give a
+# 16 bit index into a table of the flipped centres of all 65536 possible 4 x 4 nodes, worked out once with numpy.
+
+# axial offsets (q, r) of the quadrants nw, ne, sw and se of a node, in units of the quadrant size
+QUADRANT_OFFSETS = [(0, 0), (1, 0), (0, 1), (1, 1)]
+
+
+@functools.lru_cache(maxsize=None)
+def flip_4x4_table():
+    """
+    return the lookup tables of flip_4x4_node: a dict of the code of each 2 x 2 node (bit k is quadrant k's tile), and
+    the list of the flipped centres of the 4 x 4 nodes, indexed by the codes of their quadrants (nw in the lowest bits)
+    """
+    # the tiles of every 4 x 4 node, as rows of axial coords, tiles[index, r, q]
+    bits = (np.arange(1 << 16)[:, None] >> np.arange(16)) & 1
+    tiles = np.zeros((1 << 16, 4, 4), dtype=np.uint8)
+    for bit in range(16):
+        (quad_q, quad_r), (dq, dr) = QUADRANT_OFFSETS[bit // 4], QUADRANT_OFFSETS[bit % 4]
+        tiles[:, 2*quad_r + dr, 2*quad_q + dq] = bits[:, bit]
+
+    # flip the centre 2 x 2 tiles, in the order of the quadrants of the result
+    centre_codes = np.zeros(1 << 16, dtype=np.int64)
+    for k, (q, r) in enumerate(QUADRANT_OFFSETS):
+        q, r = q + 1, r + 1
+        numb_blacks = sum(tiles[:, r + dr, q + dq] for dq, dr in [(1, 0), (-1, 0), (0, 1), (0, -1), (1, -1), (-1, 1)])
+        # black and 1 or 2 black neighbs stays black (0 or >2 -> white), white and 2 black neighbs -> black
+        is_black = (numb_blacks == 2) | ((tiles[:, r, q] == 1) & (numb_blacks == 1))
+        centre_codes |= is_black.astype(np.int64) << k
+
+    nodes_2x2 = [join_nodes(*[BLACK_TILE if (code >> k) & 1 else WHITE_TILE for k in range(4)]) for code in range(16)]
+    codes = {node: code for code, node in enumerate(nodes_2x2)}
+    return codes, [nodes_2x2[code] for code in centre_codes.tolist()]
+
+
+def flip_4x4_node(node):
+    """
+    return the centre 2 x 2 tiles of a 4 x 4 node after one generation
+    """
+    codes, flipped = flip_4x4_table()
+    return flipped[codes[node.nw] | (codes[node.ne] << 4) | (codes[node.sw] << 8) | (codes[node.se] << 12)]
+
+
+@functools.lru_cache(maxsize=HASHLIFE_CACHE_SIZE)
+def node_future(node, j):
+    """
+    return the centre of node (one level down) after 2^j generations, for j <= node.level - 2
+    """
+    if node.population == 0:
+        return node.nw
+    if node.level == 2:
+        return flip_4x4_node(node)
+
+    # the nine overlapping sub-blocks one level down, advanced by up to 2^(level-3) generations
+    nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+    sub_j = min(j, node.level - 3)
+    c1 = node_future(nw, sub_j)
+    c2 = node_future(join_nodes(nw.ne, ne.nw, nw.se, ne.sw), sub_j)
+    c3 = node_future(ne, sub_j)
+    c4 = node_future(join_nodes(nw.sw, nw.se, sw.nw, sw.ne), sub_j)
+    c5 = node_future(join_nodes(nw.se, ne.sw, sw.ne, se.nw), sub_j)
+    c6 = node_future(join_nodes(ne.sw, ne.se, se.nw, se.ne), sub_j)
+    c7 = node_future(sw, sub_j)
+    c8 = node_future(join_nodes(sw.ne, se.nw, sw.se, se.sw), sub_j)
+    c9 = node_future(se, sub_j)
+
+    if j < node.level - 2: # already far enough, take the centres of the four quadrants
+        return join_nodes(
+            join_nodes(c1.se, c2.sw, c4.ne, c5.nw), join_nodes(c2.se, c3.sw, c5.ne, c6.nw),
+            join_nodes(c4.se, c5.sw, c7.ne, c8.nw), join_nodes(c5.se, c6.sw, c8.ne, c9.nw),
+        )
+
+    # otherwise advance the four quadrants by another 2^(level-3) generations
+    return join_nodes(
+        node_future(join_nodes(c1, c2, c4, c5), sub_j), node_future(join_nodes(c2, c3, c5, c6), sub_j),
+        node_future(join_nodes(c4, c5, c7, c8), sub_j), node_future(join_nodes(c5, c6, c8, c9), sub_j),
+    )
+
+
+def hashlife_from_tiles(tiles_dict):
+    """
+    build the quadtree of the black tiles in the dict. Returns the node and the axial coords (q, r) of its top left tile.
+    """
+    black_tiles = black_tiles_set(tiles_dict)
+    qrs = [((x - y) // 2, y) for x, y in black_tiles] or [(0, 0)]
+    q0 = min(q for q, r in qrs)
+    r0 = min(r for q, r in qrs)
+    span = max(max(q for q, r in qrs) - q0, max(r for q, r in qrs) - r0) + 1
+    level = max(span - 1, 1).bit_length()
+
+    # build the tree bottom up, grouping the nodes of each level into their parents
+    nodes = {(q - q0, r - r0): BLACK_TILE for q, r in qrs} if black_tiles else {}
+    for k in range(level):
+        white = white_node(k)
+        parents = collections.defaultdict(lambda: [white] * 4)
+        for (q, r), node in nodes.items():
+            parents[q // 2, r // 2][(q % 2) + 2 * (r % 2)] = node
+        nodes = {qr: join_nodes(*quads) for qr, quads in parents.items()}
+
+    return nodes.get((0, 0), white_node(level)), (q0, r0)
+
+
+def hashlife_is_padded(node):
+    """
+    return whether all the black tiles of node are in its central quarter, so none leave its centre in 2^(level-3) generations
+    """
+    if node.level < 3:
+        return False
+    centre_population = node.nw.se.se.population + node.ne.sw.sw.population \
+        + node.sw.ne.ne.population + node.se.nw.nw.population
+    return centre_population == node.population
+
+
+def hashlife_advance(node, origin, generations):
+    """
+    advance the quadtree by any number of generations, jumping by the largest power of two each time. Returns the new
+    node and the axial coords of its top left tile.
+    """
+    q0, r0 = origin
+    while generations > 0 and node.population > 0:
+        j = generations.bit_length() - 1
+
+        # grow the tree until the pattern cannot leave the part that is returned
+        while node.level < j + 3 or not hashlife_is_padded(node):
+            shift = 1 << (node.level - 1)
+            node = centre_node(node)
+            q0, r0 = q0 - shift, r0 - shift
+
+        shift = 1 << (node.level - 2)
+        node = node_future(node, j)
+        q0, r0 = q0 + shift, r0 + shift
+        generations -= 1 << j
+
+    return node, (q0, r0)
+
+
+def hashlife_black_tiles(node, origin):
+    """
+    return the set of black tiles in the quadtree, in the doubled x coords used by tiles_dict
+    """
+    black_tiles = set()
+    stack = [(node, origin[0], origin[1])]
+    while stack:
+        node, q, r = stack.pop()
+        if node.population == 0:
+            continue
+        if node.level == 0:
+            black_tiles.add((2*q + r, r))
+            continue
+        half = 1 << (node.level - 1)
+        stack += [(node.nw, q, r), (node.ne, q + half, r), (node.sw, q, r + half), (node.se, q + half, r + half)]
+
+    return black_tiles
+
+
+def hashlife_black_count(tiles_dict, generation):
+    """
+    return the number of black tiles after any number of generations, starting from the dict of tiles
+    """
+    node, origin = hashlife_from_tiles(tiles_dict)
+    node, origin = hashlife_advance(node, origin, generation)
+    return node.population
+
+
+# Command line: count the black tiles after following the instructions, and after the simulation, e.g.
+# python day24_flippingTiles.py day24_input.txt --engine dense --generations 1000
+
+# engines for the simulation on the command line (run_engine also takes 'hashlife', for periodic patterns only)
+ENGINES = ['set', 'dense', 'numba', 'double-buffered', 'dict']
+
+def run_engine(tiles_dict, generations=100, engine='set', observer=None, trajectory_path=None):
+    """
+    run the simulation with an engine from ENGINES or 'hashlife', and return the number of black tiles after the last
+    generation. If a trajectory_path is passed the run is saved there (set engine only).
+    """
+    if engine == 'set':
+        return run_set_simulation(tiles_dict, generations, observer, trajectory_path=trajectory_path)[-1]
+    if (observer is not None) or (trajectory_path is not None):
+        raise ValueError(f'only the set engine can be observed or save a trajectory, not {engine!r}')
+    if engine == 'dense':
+        return run_dense_simulation(tiles_dict, generations)[-1]
+    if engine == 'numba':
+        return run_dense_simulation(tiles_dict, generations, numba_flip_grid())[-1]
+    if engine == 'double-buffered':
+        return run_double_buffered_tiles(tiles_dict, generations)[-1]
+    if engine == 'hashlife':
+        return hashlife_black_count(tiles_dict, generations)
+    if engine == 'dict':
+        return run_dict_simulation(tiles_dict, generations)[-1]
+    raise ValueError(f'unknown engine {engine!r}, choose from {", ".join(ENGINES + ["hashlife"])}')
+
+
+# bump when a change to the rules or engines changes their results, so older cached results are not used
+RESULTS_VERSION = 1
+
+def cached_set_simulation(file_path, generations=100, cache_dir='.simulation_cache', max_bytes=1 << 30):
+    """
+    run the set simulation on a tile instructions file, with the result cached in cache_dir (see result_cache.py) under
+    the hash of the file, the number of generations and RESULTS_VERSION. Returns the set of black tiles after the last
+    generation, the number of black tiles after each generation (as run_set_simulation), and the number of generations
+    simulated (fewer than generations if the tiles reached a fixed point or a cycle).
+    """
+    key = result_cache.file_cache_key(file_path, puzzle='day24', generations=generations, engine='set',
+                                      version=RESULTS_VERSION)
+
+    def compute():
+        tiles_dict = flip_tiles_from_directions(read_tile_directions(file_path))
+        sim_run = simulate_black_tiles(black_tiles_set(tiles_dict), generations)
+        black_tiles = cycle_detection.state_at_generation(sim_run, generations, flip_black_tiles_step)
+        numb_black_list = [cycle_detection.count_at_generation(sim_run, i) for i in range(1, generations + 1)]
+        return {'black_tiles': np.array(sorted(black_tiles), dtype=np.int64).reshape(-1, 2),
+                'numb_black_list': numb_black_list, 'iterations': sim_run.generation}
+
+    result = result_cache.cached(cache_dir, key, compute, max_bytes)
+    black_tiles = set(map(tuple, result['black_tiles'].tolist()))
+    return black_tiles, result['numb_black_list'].tolist(), int(result['iterations'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the day 24 hex tile simulation.')
+    parser.add_argument('input', nargs='?', default='day24_input.txt', help='tile instructions file')
+    parser.add_argument('--part', choices=['1', '2', 'both'], default='both')
+    parser.add_argument('--engine', choices=ENGINES, default='set')
+    parser.add_argument('--generations', type=int, default=100)
+    parser.add_argument('--stream', action='store_true', help='read the instructions in parallel chunks (large files)')
+    parser.add_argument('--telemetry', help='file to write a JSON line per generation to (- for stdout)')
+    parser.add_argument('--trajectory-dir', help='directory to save the trajectory of the simulation in')
+    parser.add_argument('--cache-dir', help='directory to cache the results in, to skip simulating the same input again')
+    parser.add_argument('--cache-max-bytes', type=int, default=1 << 30)
+    args = parser.parse_args(argv)
+    if (args.telemetry or args.trajectory_dir or args.cache_dir) and args.engine != 'set':
+        parser.error('only the set engine can be observed, save a trajectory or be cached')
+    if args.cache_dir and (args.telemetry or args.trajectory_dir):
+        parser.error('a cached run cannot be observed or save a trajectory')
+
+    # a cached run reads the instructions itself, if it is not in the cache
+    if (args.part in ('1', 'both')) or not args.cache_dir:
+        if args.stream:
+            tiles_dict = load_tiles_dict(args.input)
+        else:
+            tiles_dict = flip_tiles_from_directions(read_tile_directions(args.input))
+
+    if args.part in ('1', 'both'):
+        print(f'There are {number_black_tiles(tiles_dict)} black tiles')
+
+    if (args.part in ('2', 'both')) and args.cache_dir:
+        black_tiles, numb_black_list, _ = cached_set_simulation(args.input, args.generations, args.cache_dir,
+                                                                args.cache_max_bytes)
+        print(f'There are {numb_black_list[-1]} black tiles')
+
+    elif args.part in ('2', 'both'):
+        telemetry = None
+        if args.telemetry == '-':
+            telemetry = sys.stdout
+        elif args.telemetry:
+            telemetry = open(args.telemetry, 'w')
+        observer = instrumentation.jsonl_sink(telemetry) if telemetry else None
+
+        try:
+            black_tile_count = run_engine(tiles_dict, args.generations, args.engine, observer, args.trajectory_dir)
+            print(f'There are {black_tile_count} black tiles')
+        finally:
+            if telemetry not in (None, sys.stdout):
+                telemetry.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import numpy as np
+
+# Allocation free stepping, shared by the seating plan (day 11) and hex tile (day 24) simulations.
+
+# The usual steps allocate a new state, masks and a list of changes every generation, which on long runs over large
+# inputs is a good part of the time and of the peak memory. The double buffered steppers (see double_buffered_stepper
+# in day 11 and double_buffered_tile_stepper in day 24) allocate everything once instead: two states that swap roles
+# every generation (the current one is read, the other is overwritten with the next), scratch arrays, and a change
+# buffer with room for every position. Each step only writes into these, through numpy's out= arguments. (The tile
+# stepper's grids grow with the tiles, so it allocates again, but only when the tiles outgrow them.)
+# Some numpy functions still allocate with out=: take and put buffer out unless mode is 'clip' or 'wrap', reductions
+# buffer when they cast, and compress always makes a temporary index, so the steppers avoid those. Ufuncs over strided
+# views (e.g. a window of a grid) may use numpy's own iteration buffer, but that has a fixed size (np.getbufsize()),
+# however large the state.
+
+
+def compressor(capacity):
+    """
+    Returns compress(mask, values, out), which writes values[mask] to the start of out and returns how many there are,
+    the same as np.compress, but without allocating. mask and values are 1d arrays of the same length, up to capacity,
+    and out must have room for one more than values (a spare slot, which is overwritten).
+    """
+    slots_buffer = np.empty(capacity, dtype=np.int64)
+    unmasked_buffer = np.empty(capacity, dtype=bool)
+
+    def compress(mask, values, out):
+        spare = len(values)
+        if spare == 0:
+            return 0
+        slots = slots_buffer[:spare]
+        unmasked = unmasked_buffer[:spare]
+
+        # the slot of each masked value is the number of masked values before it, the others all go in the spare slot
+        np.copyto(slots, mask)
+        np.cumsum(slots, out=slots)
+        num_masked = int(slots[-1])
+        np.subtract(slots, 1, out=slots)
+        np.logical_not(mask, out=unmasked)
+        np.copyto(slots, spare, where=unmasked)
+        np.put(out, slots, values, mode='clip')
+        return num_masked
+
+    return compress
@@ -0,0 +1,131 @@
+import json
+import os
+import pstats
+import sys
+import time
+
+# Per generation telemetry for the seating plan (day 11) and hex tile (day 24) simulations.
+
+# An observer is any function that takes a record (a dict) for a generation. To observe a simulation, its step is
+# wrapped with observed_step, which times each call and, once the next step starts (or the run finishes), passes the
+# observer a record of the generation: its wall time, the time spent in each phase, the number of cells that changed,
+# the population and the memory in use. Kernels time their own phases (e.g. neighbour counting and rule application)
+# with start_phase and end_phase, and so can the code between steps (e.g. hashing and rendering), so everything done
+# for a generation is counted in its record. When nothing is observed, phase_times is None and start_phase/end_phase
+# return straight away, so the only cost is a couple of function calls per generation.
+
+# time spent in each phase of the generation being observed, or None when nothing is observed
+phase_times = None
+
+
+def start_phase():
+    """returns the time a phase starts, or None when nothing is observed"""
+    if phase_times is None:
+        return None
+    return time.perf_counter()
+
+
+def end_phase(name, start):
+    """adds the time since start to the named phase, and returns the time now (the start of the next phase)"""
+    if (start is None) or (phase_times is None):
+        return None
+    now = time.perf_counter()
+    phase_times[name] = phase_times.get(name, 0.0) + (now - start)
+    return now
+
+
+def memory_in_use():
+    """
+    returns the resident memory of the process in bytes now, from /proc/self/statm (linux), or where that cannot be
+    read the peak resident memory so far (the most it can have been). None where neither can be measured.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def observed_step(step, observer, population, every=1, profiler=None):
+    """
+    Wrap a simulation step (as used by cycle_detection.run_until_cycle) so that observer is passed a record of every
+    every-th generation. population(state) gives the population recorded, and is timed as the counting phase. If a
+    cProfile.Profile is passed as profiler, it is enabled only while the steps run. Returns the wrapped step, and a
+    function to call when the run finishes, which passes on the record of the last generation.
+    """
+    generation = 0
+    pending = None # record of the last generation, finished when the next step starts
+
+    def finish_record():
+        nonlocal pending
+        global phase_times
+        if pending is not None:
+            record, started = pending
+            pending = None
+            record['seconds'] = time.perf_counter() - started
+            record['phases'] = phase_times
+            phase_times = None
+            observer(record)
+
+    def wrapped_step(state):
+        nonlocal generation, pending
+        global phase_times
+        finish_record()
+        generation += 1
+
+        # only every every-th generation is timed, so sampling a long run costs almost nothing
+        if generation % every != 0:
+            return step(state)
+
+        phase_times = {}
+        started = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            state, changed, count = step(state)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        step_end = time.perf_counter()
+
+        # kernels that do not time their own phases are counted as applying the rules
+        if not phase_times:
+            phase_times['rules'] = step_end - started
+
+        pop = population(state)
+        end_phase('counting', step_end)
+
+        record = {
+            'generation': generation,
+            'changed': len(changed),
+            'population': int(pop),
+            'memory_bytes': memory_in_use(),
+        }
+        pending = (record, started)
+        return state, changed, count
+
+    return wrapped_step, finish_record
+
+
+def jsonl_sink(file):
+    """returns an observer that writes each record as a line of JSON to an open file"""
+    def write_record(record):
+        file.write(json.dumps(record) + '\n')
+        file.flush()
+
+    return write_record
+
+
+def print_profile(profiler, sort='cumulative', limit=20, file=sys.stderr):
+    """print the functions that took the most time in a cProfile.Profile"""
+    pstats.Stats(profiler, stream=file).sort_stats(sort).print_stats(limit)
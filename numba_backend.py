@@ -0,0 +1,17 @@
+import functools
+
+# Loading the optional numba kernels (numba_kernels.py), shared by the seating plan (day 11) and hex tile (day 24)
+# simulations and the rule engine.
+
+# numba takes a while to import, so the kernels are only imported the first time they are asked for, and importing
+# the scripts stays fast. Without numba, kernels_module returns None and the callers fall back to their numpy engines.
+
+
+@functools.lru_cache(maxsize=None)
+def kernels_module():
+    """imports the numba kernels the first time they are needed, or returns None if numba is not installed"""
+    try:
+        import numba_kernels
+    except ImportError:
+        return None
+    return numba_kernels
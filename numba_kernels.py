@@ -0,0 +1,112 @@
+import numba
+import numpy as np
+
+# Optional compiled kernels for the seating plan (day 11) and hex tile (day 24) simulations, used when numba is
+# installed. They are imported through numba_backend.kernels_module, and the callers fall back to the numpy engines
+# without numba. test_kernels.py checks them against the reference functions.
+
+# The first-visible-seat scans of part two are awkward to vectorise: each seat looks along 8 lines until it meets a
+# seat, however far that is. As plain loops compiled with numba they are simple and fast, and the rows of the plan are
+# split between threads (prange). The same kernel runs part one, with the scans stopped after one cell. The hex kernel
+# counts the six black neighbours of every tile of the dense grid in one pass, instead of six shifted copies.
+# The rules are passed in as a table of which counts turn a cell on (see rule_engine.py), so every variant of the
+# rules runs the same compiled code.
+# cache=True keeps the compiled code in __pycache__, so only the first process to use a kernel pays to compile it.
+
+# row and column steps of the 8 directions a seat looks in
+SIGHT_ROW_STEPS = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+SIGHT_COL_STEPS = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+
+def seat_rule_table(leave_at):
+    """
+    returns the rule table of the puzzle's seat rules (see rule_engine.rule_table): an empty seat is taken if no
+    occupied seats are seen, an occupied one is left if leave_at or more are
+    """
+    table = np.zeros(2 * 9, dtype=np.bool_)
+    table[0] = True
+    table[9:9 + leave_at] = True
+    return table
+
+
+# the rule table of the puzzle's hex rules: a white tile with 2 black neighbours turns black, a black tile with 1 or 2
+# stays black
+HEX_RULE_TABLE = np.array([False, False, True, False, False, False, False,
+                           False, True, True, False, False, False, False])
+
+
+def apply_seat_rules(sp, leave_at, max_distance):
+    """
+    Apply the seat rules to a bordered seating plan, looking at most max_distance cells along each direction for a
+    seat (0 for no limit). Returns the new plan and a boolean array of the seats that changed.
+    """
+    return apply_seat_table(sp, seat_rule_table(leave_at), max_distance)
+
+
+@numba.njit(parallel=True, cache=True)
+def apply_seat_table(sp, table, max_distance):
+    """
+    Apply any seat rules to a bordered seating plan, as apply_seat_rules, where a seat is occupied next if
+    table[9*occupied + number of occupied seats seen] (see rule_engine.rule_table).
+    """
+    rr, cc = sp.shape
+    spu = sp.copy()
+    changed = np.zeros((rr, cc), dtype=np.bool_)
+
+    for i in numba.prange(1, rr - 1):
+        for j in range(1, cc - 1):
+            st = sp[i, j]
+            if st == 0:
+                continue
+
+            # count the occupied seats seen in each direction, stopping at the first seat or the edge
+            occ_number = 0
+            for d in range(8):
+                y = i + SIGHT_ROW_STEPS[d]
+                x = j + SIGHT_COL_STEPS[d]
+                distance = 1
+                while (0 <= y < rr) and (0 <= x < cc):
+                    if sp[y, x] != 0:
+                        if sp[y, x] == 1:
+                            occ_number += 1
+                        break
+                    if distance == max_distance:
+                        break
+                    y += SIGHT_ROW_STEPS[d]
+                    x += SIGHT_COL_STEPS[d]
+                    distance += 1
+
+            occupied = st == 1
+            if table[9*occupied + occ_number] != occupied:
+                spu[i, j] = -st
+                changed[i, j] = True
+
+    return spu, changed
+
+
+def flip_hex_grid(grid):
+    """
+    flip all the tiles in the dense axial grid simultaneously (as flip_dense_grid) and return the new grid. The outer
+    rows and columns must be white and not have any black neighbours.
+    """
+    return flip_hex_table(grid, HEX_RULE_TABLE)
+
+
+@numba.njit(parallel=True, cache=True)
+def flip_hex_table(grid, table):
+    """
+    flip all the tiles in the dense axial grid with any rules, as flip_hex_grid, where a tile is black next if
+    table[7*black + number of black neighbours] (see rule_engine.rule_table)
+    """
+    rr, cc = grid.shape
+    grid_new = np.zeros((rr, cc), dtype=np.uint8)
+
+    for r in numba.prange(1, rr - 1):
+        for q in range(1, cc - 1):
+            numb_blacks = (grid[r, q + 1] + grid[r, q - 1] + grid[r + 1, q] + grid[r - 1, q]
+                           + grid[r - 1, q + 1] + grid[r + 1, q - 1])
+            if table[7*grid[r, q] + numb_blacks]:
+                grid_new[r, q] = 1
+
+    return grid_new
+
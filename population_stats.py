@@ -0,0 +1,66 @@
+import collections
+import numpy as np
+
+# Population statistics kept up to date while a simulation runs, shared by the seating plan (day 11) and hex tile
+# (day 24) simulations.
+
+# Counting the occupied seats or black tiles after every generation means another pass over the whole state. But
+# each generation only turns some positions on and some off, and the step already knows which, so the statistics can
+# be updated from the changes alone: the population, the number of positions on in each row and column, and how many
+# were turned on and off in the last generation. The statistics are a dict, so reading any of them costs nothing.
+# For a grid (day 11) the rows and columns are numpy arrays; for the unbounded hex tiles they are Counters, keyed by
+# the first and second coords. count_occupied_seats and number_black_tiles are kept to cross-check them.
+
+
+def new_stats(positions, shape=None):
+    """
+    Returns the statistics of a state with the (n, 2) positions on: 'population', 'rows' and 'cols' (the number of
+    positions on in each), 'turned_on' and 'turned_off' (in the last generation) and 'generation'. If the shape of a
+    grid is given, rows and cols are arrays, otherwise Counters.
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    if shape is None:
+        rows = collections.Counter(positions[:, 0].tolist())
+        cols = collections.Counter(positions[:, 1].tolist())
+    else:
+        rows = np.bincount(positions[:, 0], minlength=shape[0])
+        cols = np.bincount(positions[:, 1], minlength=shape[1])
+
+    return {'population': len(positions), 'rows': rows, 'cols': cols, 'turned_on': 0, 'turned_off': 0,
+            'generation': 0}
+
+
+def update_stats(stats, turned_on, turned_off):
+    """update the statistics with the (n, 2) positions turned on and off in a generation"""
+    turned_on = np.asarray(turned_on, dtype=np.int64).reshape(-1, 2)
+    turned_off = np.asarray(turned_off, dtype=np.int64).reshape(-1, 2)
+
+    rows, cols = stats['rows'], stats['cols']
+    if isinstance(rows, collections.Counter):
+        rows.update(turned_on[:, 0].tolist())
+        rows.subtract(turned_off[:, 0].tolist())
+        cols.update(turned_on[:, 1].tolist())
+        cols.subtract(turned_off[:, 1].tolist())
+    else:
+        rows += np.bincount(turned_on[:, 0], minlength=len(rows)) - np.bincount(turned_off[:, 0], minlength=len(rows))
+        cols += np.bincount(turned_on[:, 1], minlength=len(cols)) - np.bincount(turned_off[:, 1], minlength=len(cols))
+
+    stats['population'] += len(turned_on) - len(turned_off)
+    stats['turned_on'] = len(turned_on)
+    stats['turned_off'] = len(turned_off)
+    stats['generation'] += 1
+
+
+def stats_step(step, stats, is_on):
+    """
+    Wrap a simulation step (as used by cycle_detection.run_until_cycle) so it keeps stats up to date. is_on(state,
+    changed) must return whether each of the (n, 2) changed positions is on in the new state.
+    """
+    def wrapped_step(state):
+        state, changed, count = step(state)
+        positions = np.asarray(changed, dtype=np.int64).reshape(-1, 2)
+        on = np.asarray(is_on(state, positions), dtype=bool)
+        update_stats(stats, positions[on], positions[~on])
+        return state, changed, count
+
+    return wrapped_step
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import numpy as np
+
+# On-disk cache of simulation results, shared by the seating plan (day 11) and hex tile (day 24) simulations.
+
+# A result is found by a key made from the hash of the input file's bytes, the rule parameters, and the version of the
+# engine that made it (bump RESULTS_VERSION in a script when a change to it changes its results), so an edited input
+# or new rules never return an old result. Each result is a .npz file of named arrays, named by its key. Several
+# processes can share a cache directory without any locks: a result is written to a temporary file and then renamed
+# into place, which is atomic, so a reader sees the whole file or no file. Reading a result touches its modification
+# time, and when the cache grows past its size cap the least recently used results are deleted.
+
+CACHE_SUFFIX = '.npz'
+
+# temporary files older than this (in seconds) were left by a writer that died, and are deleted
+STALE_TEMP_AGE = 3600
+
+
+# files are hashed this many bytes at a time, so a large input is never all in memory
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def params_key(digest, params):
+    """returns the key of a result from the digest of its input and the parameters (JSON serialisable)"""
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def cache_key(input_bytes, **params):
+    """
+    returns the key (a hex sha256) of a result, from the input bytes (or any buffer, e.g. a memory mapped file) and the
+    parameters (JSON serialisable)
+    """
+    return params_key(hashlib.sha256(input_bytes), params)
+
+
+def file_cache_key(file_path, **params):
+    """returns the key of a result for an input file, the same as cache_key of its bytes, reading it in chunks"""
+    digest = hashlib.sha256()
+    chunk = bytearray(HASH_CHUNK_BYTES)
+    with open(file_path, 'rb') as f:
+        size = f.readinto(chunk)
+        while size:
+            digest.update(memoryview(chunk)[:size])
+            size = f.readinto(chunk)
+    return params_key(digest, params)
+
+
+def load_result(cache_dir, key):
+    """returns the dict of arrays cached under key, or None if there is none"""
+    path = os.path.join(cache_dir, key + CACHE_SUFFIX)
+    try:
+        with np.load(path) as f:
+            result = {name: f[name] for name in f.files}
+    except FileNotFoundError:
+        return None
+
+    # mark it as recently used. It may have just been evicted by another process, which is fine
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return result
+
+
+def save_result(cache_dir, key, result, max_bytes=1 << 30):
+    """
+    cache a dict of arrays under key, then evict the least recently used results until the cache is under max_bytes
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # write to a temporary file in the same directory, then rename it into place
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **result)
+        os.chmod(temp_path, 0o644) # mkstemp makes it private, but the cache may be shared
+        os.replace(temp_path, os.path.join(cache_dir, key + CACHE_SUFFIX))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+    evict_results(cache_dir, max_bytes)
+
+
+def evict_results(cache_dir, max_bytes):
+    """delete the least recently used results until the results in cache_dir take at most max_bytes"""
+    entries = []
+    now = time.time()
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError: # deleted by another process
+                continue
+            if entry.name.endswith(CACHE_SUFFIX):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif entry.name.endswith('.tmp') and (now - stat.st_mtime > STALE_TEMP_AGE):
+                remove_quietly(entry.path)
+
+    total_bytes = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        remove_quietly(path)
+        total_bytes -= size
+
+
+def remove_quietly(path):
+    """delete a file, unless another process already has (or, on windows, has it open)"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def cached(cache_dir, key, compute, max_bytes=1 << 30):
+    """returns the result cached under key, or computes it with compute() (a dict of arrays) and caches it"""
+    result = load_result(cache_dir, key)
+    if result is None:
+        result = {name: np.asarray(value) for name, value in compute().items()}
+        save_result(cache_dir, key, result, max_bytes)
+    return result
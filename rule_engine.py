@@ -0,0 +1,355 @@
+import argparse
+import collections
+import functools
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import instrumentation
+import numba_backend
+import simulation_runs
+import trajectory
+import day11_seatingPlanSimulation as day11
+import day24_flippingTiles as day24
+
+# Rule engine: run any variant of the seating plan (day 11) and hex tile (day 24) rules, e.g. to sweep thousands of
+# them over an input.
+
+# Both puzzles follow the same kind of rule: whether a cell is on (an occupied seat, a black tile) next generation only
+# depends on whether it is on now and how many of its neighbours are. So a rule is a neighbourhood, and the numbers of
+# neighbours on for which a cell turns on (birth) and stays on (survival):
+#   moore  the 8 adjacent cells of a seating plan (day 11 part one: birth 0, survival 0-3)
+#   sight  the first seat seen in each of the 8 directions (day 11 part two: birth 0, survival 0-4)
+#   hex    the 6 neighbouring tiles (day 24: birth 2, survival 1-2)
+# A rule is compiled once into a lookup table, indexed by (neighbourhood size + 1) * on + neighbours on, and the table is
+# passed to the fastest kernel for its neighbourhood: the numba kernels if numba is installed, otherwise a numpy gather
+# through the neighbour index (seats) or a sum of shifted grids (tiles). Every rule costs the same, and a sweep never
+# compiles anything again. The neighbour index only depends on where the seats are, so it is built once per plan.
+# All the rules then run through the same plumbing as the puzzles' engines: cycle_detection to stop at a fixed point
+# or cycle, population_stats, instrumentation observers, and trajectories, which are rendered with day 11's video code.
+# Run with: python rule_engine.py day24_input.txt --rule hex:B2/S12 --rule hex:B2/S123 --max-generations 100
+
+# number of neighbours in each neighbourhood
+NEIGHBOURHOOD_SIZES = {'moore': 8, 'sight': 8, 'hex': 6}
+
+# a neighbourhood, and the frozensets of the numbers of neighbours on for which a cell turns on and stays on
+Rule = collections.namedtuple('Rule', ['neighbourhood', 'birth', 'survival'])
+
+# the dense grid of black tiles (see day24.tiles_dense_grid), and the axial coords of grid[0, 0]
+TileGrid = collections.namedtuple('TileGrid', ['grid', 'origin'])
+
+
+def make_rule(neighbourhood, birth, survival):
+    """
+    Returns a Rule. Raises a ValueError for an unknown neighbourhood, a number of neighbours it cannot have, or a hex
+    rule with birth at 0 (the endless white plane around the tiles would all turn black).
+    """
+    if neighbourhood not in NEIGHBOURHOOD_SIZES:
+        raise ValueError(f'unknown neighbourhood {neighbourhood!r}, choose from {", ".join(NEIGHBOURHOOD_SIZES)}')
+    size = NEIGHBOURHOOD_SIZES[neighbourhood]
+    birth, survival = frozenset(birth), frozenset(survival)
+
+    invalid = sorted(count for count in birth | survival if not 0 <= count <= size)
+    if invalid:
+        raise ValueError(f'a cell has 0 to {size} {neighbourhood} neighbours, not {invalid}')
+    if (neighbourhood == 'hex') and (0 in birth):
+        raise ValueError('a hex rule cannot have birth at 0, every tile of the endless white plane would turn black')
+
+    return Rule(neighbourhood, birth, survival)
+
+
+def threshold_rule(neighbourhood, birth, survival):
+    """
+    returns the Rule where a cell turns on (birth) or stays on (survival) when the number of its neighbours on is in
+    the (least, most) range, inclusive
+    """
+    return make_rule(neighbourhood, range(birth[0], birth[1] + 1), range(survival[0], survival[1] + 1))
+
+
+SEATING_RULE_1 = threshold_rule('moore', (0, 0), (0, 3))
+SEATING_RULE_2 = threshold_rule('sight', (0, 0), (0, 4))
+TILE_RULE = threshold_rule('hex', (2, 2), (1, 2))
+
+
+def parse_rule(text):
+    """parse a rule written as neighbourhood:B<counts>/S<counts>, e.g. hex:B2/S12 (the counts are single digits)"""
+    neighbourhood, _, counts = text.partition(':')
+    birth, _, survival = counts.upper().partition('/')
+    if not (birth.startswith('B') and survival.startswith('S') and (birth[1:] + survival[1:]).isdigit()):
+        raise ValueError(f'{text!r} is not a rule like hex:B2/S12')
+    return make_rule(neighbourhood, map(int, birth[1:]), map(int, survival[1:]))
+
+
+def rule_name(rule):
+    """returns the rule written as parse_rule reads it"""
+    birth = ''.join(map(str, sorted(rule.birth)))
+    survival = ''.join(map(str, sorted(rule.survival)))
+    return f'{rule.neighbourhood}:B{birth}/S{survival}'
+
+
+def rule_table(rule):
+    """
+    returns the rule as a boolean lookup table: a cell is on next generation if table[(size + 1)*on + number of
+    neighbours on], where on is 0 or 1 and size is the number of neighbours in its neighbourhood
+    """
+    size = NEIGHBOURHOOD_SIZES[rule.neighbourhood]
+    table = np.zeros(2 * (size + 1), dtype=bool)
+    table[sorted(rule.birth)] = True
+    table[[size + 1 + count for count in sorted(rule.survival)]] = True
+    return table
+
+
+def initial_state(neighbourhood, file_path):
+    """
+    load the starting state for a neighbourhood: the bordered seating plan of a day 11 input for moore and sight, or
+    the TileGrid of the black tiles of a day 24 input for hex
+    """
+    if neighbourhood == 'hex':
+        grid, origin = day24.tiles_dense_grid(day24.load_tiles_dict(file_path, num_workers=0))
+        return TileGrid(grid, origin)
+    return day11.load_seat_plan(file_path)
+
+
+# Seating plans, for the moore and sight neighbourhoods. The positions are the (row, col) of the seats.
+
+@functools.lru_cache(maxsize=16)
+def cached_neighbour_index(neighbourhood, shape, seat_bits):
+    """builds the neighbour index for the layout of seats packed in seat_bits"""
+    is_seat = np.unpackbits(np.frombuffer(seat_bits, dtype=np.uint8), count=shape[0] * shape[1]).reshape(shape)
+    build_index = day11.build_adjacent_index if neighbourhood == 'moore' else day11.build_sight_index
+    return build_index(is_seat)
+
+
+def seat_neighbour_index(sp, neighbourhood):
+    """
+    returns the flat positions of the seats in the plan, and the index of their moore or sight neighbours (see
+    day11.build_adjacent_index and build_sight_index), built only once for each layout of seats
+    """
+    return cached_neighbour_index(neighbourhood, sp.shape, np.packbits(sp != 0).tobytes())
+
+
+def apply_seat_table(sp, table, seat_flat, neighb_index):
+    """
+    Apply a rule table to a bordered seating plan, gathering the occupied neighbours of every seat through the
+    neighbour index. Returns the new plan, the (n, 2) positions of the seats that changed and the number occupied.
+    """
+    phase_start = instrumentation.start_phase()
+    occ_flat = sp.ravel() == 1
+    occ_number = occ_flat[neighb_index].sum(axis=1)
+    occupied = occ_flat[seat_flat]
+    phase_start = instrumentation.end_phase('neighbours', phase_start)
+
+    occupied_new = table[(len(table) // 2)*occupied + occ_number]
+    changed = occupied_new != occupied
+    spu = np.array(sp)
+    spu.ravel()[seat_flat[changed]] = np.where(occupied_new[changed], 1, -1)
+
+    # seat_flat is sorted, so the changes are in row-major order
+    changes = np.column_stack(np.divmod(seat_flat[changed], sp.shape[1]))
+    instrumentation.end_phase('rules', phase_start)
+
+    return spu, changes, int(np.count_nonzero(occupied_new))
+
+
+# Hex tiles, for the hex neighbourhood. The state is a TileGrid, which grows as the black tiles spread, and the
+# positions are the doubled x coords used by day 24's tiles_dict, so trajectories match the set engine's.
+
+def tile_positions(state):
+    """returns the (n, 2) positions of the black tiles, in doubled x coords"""
+    rs, qs = np.nonzero(state.grid)
+    qs = qs + state.origin[0]
+    rs = rs + state.origin[1]
+    return np.column_stack((2*qs + rs, rs))
+
+
+def tiles_on(state, positions):
+    """returns whether the tile at each (x, y) position is black"""
+    rs = positions[:, 1] - state.origin[1]
+    qs = (positions[:, 0] - positions[:, 1]) // 2 - state.origin[0]
+    inside = (rs >= 0) & (rs < state.grid.shape[0]) & (qs >= 0) & (qs < state.grid.shape[1])
+    black = np.zeros(len(positions), dtype=bool)
+    black[inside] = state.grid[rs[inside], qs[inside]] == 1
+    return black
+
+
+def same_tiles(state, other):
+    """returns whether two TileGrids have the same black tiles, whatever the size of their grids"""
+    return np.array_equal(tile_positions(state), tile_positions(other))
+
+
+def tile_rule_step(flip_grid):
+    """returns the step for TileGrids, where flip_grid(grid) returns the next grid (see day24.flip_dense_grid)"""
+    def step(state):
+        grid, origin = day24.grow_dense_grid(state.grid, state.origin)
+        grid_new = flip_grid(grid)
+
+        phase_start = instrumentation.start_phase()
+        rs, qs = np.nonzero(grid_new != grid)
+        qs = qs + origin[0]
+        rs = rs + origin[1]
+        changes = np.column_stack((2*qs + rs, rs))
+        instrumentation.end_phase('rules', phase_start)
+
+        return TileGrid(grid_new, origin), changes, int(np.count_nonzero(grid_new))
+
+    return step
+
+
+def flip_tiles_table(grid, table):
+    """flip all the tiles in the dense grid with a rule table (as day24.flip_dense_grid), and return the new grid"""
+    phase_start = instrumentation.start_phase()
+    numb_blacks = day24.dense_black_neighbours(grid)
+    phase_start = instrumentation.end_phase('neighbours', phase_start)
+    grid_new = table[(len(table) // 2)*grid + numb_blacks].view(np.uint8)
+    instrumentation.end_phase('rules', phase_start)
+    return grid_new
+
+
+def compile_rule(rule, state):
+    """
+    Returns the step (as used by cycle_detection.run_until_cycle) for the rule, for states like state, using the
+    fastest kernel available. step(state) returns the next state, the (n, 2) positions that changed, and the number of
+    positions on.
+    """
+    table = rule_table(rule)
+    kernels = numba_backend.kernels_module()
+
+    if rule.neighbourhood == 'hex':
+        if kernels is not None:
+            return tile_rule_step(lambda grid: kernels.flip_hex_table(grid, table))
+        return tile_rule_step(functools.partial(flip_tiles_table, table=table))
+
+    if kernels is not None:
+        # moore neighbours are the first cell in each direction, sight neighbours are as far as the first seat
+        max_distance = 1 if rule.neighbourhood == 'moore' else 0
+
+        def apply_rules(sp):
+            spu, changed = kernels.apply_seat_table(sp, table, max_distance)
+            return spu, np.argwhere(changed), int(np.count_nonzero(spu == 1))
+
+        return apply_rules
+
+    seat_flat, neighb_index = seat_neighbour_index(state, rule.neighbourhood)
+    return functools.partial(apply_seat_table, table=table, seat_flat=seat_flat, neighb_index=neighb_index)
+
+
+def run_rule(rule, state, max_generations=None, observer=None, every=1, profiler=None, trajectory_path=None,
+             keyframe_interval=16, stats=None):
+    """
+    Run a rule from a state (see initial_state) with cycle_detection.run_until_cycle, until it reaches a fixed point or
+    a cycle, or max_generations. The counts of the CycleRun returned are the number of positions on after each
+    generation. observer, every and profiler, trajectory_path and keyframe_interval, and stats are as for
+    simulation_runs.run_observed, for every neighbourhood.
+    """
+    step = compile_rule(rule, state)
+    if rule.neighbourhood == 'hex':
+        return simulation_runs.run_observed(state, step, same_tiles, tile_positions, tiles_on,
+                                            max_generations=max_generations, observer=observer, every=every,
+                                            profiler=profiler, trajectory_path=trajectory_path,
+                                            keyframe_interval=keyframe_interval, stats=stats)
+
+    return simulation_runs.run_observed(state, step, np.array_equal, day11.occupied_seat_positions,
+                                        day11.seats_occupied, base=state.astype(np.int8), shape=state.shape,
+                                        max_generations=max_generations, observer=observer, every=every,
+                                        profiler=profiler, trajectory_path=trajectory_path,
+                                        keyframe_interval=keyframe_interval, stats=stats)
+
+
+def sweep_rules(rules, file_path, max_generations=None, **run_options):
+    """
+    run each rule on the input file (see run_rule), loading the input once for each kind of state, and yield the rules
+    and their CycleRuns
+    """
+    states = {}
+    for rule in rules:
+        kind = 'tiles' if rule.neighbourhood == 'hex' else 'seats'
+        if kind not in states:
+            states[kind] = initial_state(rule.neighbourhood, file_path)
+        yield rule, run_rule(rule, states[kind], max_generations, **run_options)
+
+
+def rule_frames(trajectory_path):
+    """
+    yield the state after every generation of a run saved by run_rule as a 2D array of -1 (off), 0 (floor) and 1 (on),
+    the states of a seating plan, so it can be rendered with day11.stream_video or save_images_parallel
+    """
+    traj = trajectory.load_trajectory(trajectory_path)
+    if traj.base is not None:
+        yield from day11.trajectory_seat_plans(trajectory_path)
+        return
+
+    # the tiles are drawn in axial coords, in the box of all the tiles that are ever black, found from the tiles black
+    # at the start and the changes of every generation
+    low, high = np.full(2, np.iinfo(np.int64).max), np.full(2, np.iinfo(np.int64).min)
+    for generation in range(traj.generations + 1):
+        if generation == 0:
+            positions = trajectory.positions_at_generation(traj, 0)
+        else:
+            positions = trajectory.generation_deltas(traj, generation)
+        if len(positions):
+            axial = np.column_stack([positions[:, 1], (positions[:, 0] - positions[:, 1]) // 2])
+            low, high = np.minimum(low, axial.min(axis=0)), np.maximum(high, axial.max(axis=0))
+    r0, q0 = low if low[0] <= high[0] else (0, 0)
+    shape = tuple(high - low + 1) if low[0] <= high[0] else (1, 1)
+
+    def grid_index(positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        return positions[:, 1] - r0, (positions[:, 0] - positions[:, 1]) // 2 - q0
+
+    frame = np.full(shape, -1, dtype=np.int8)
+    frame[grid_index(trajectory.positions_at_generation(traj, 0))] = 1
+    for generation in range(1, traj.generations + 1):
+        # a tile that changes goes from white (-1) to black (1) or back
+        changed = grid_index(trajectory.generation_deltas(traj, generation))
+        frame[changed] = -frame[changed]
+        yield frame.copy()
+
+
+def rule_argument(text):
+    """parse_rule for argparse, which only shows the message of an ArgumentTypeError"""
+    try:
+        return parse_rule(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run variants of the day 11 and day 24 rules on an input file.')
+    parser.add_argument('input', help='seating plan (moore and sight rules) or tile instructions (hex rules)')
+    parser.add_argument('--rule', action='append', required=True, type=rule_argument,
+                        help='rule like moore:B0/S0123, sight:B0/S01234 or hex:B2/S12 (repeat to sweep several)')
+    parser.add_argument('--max-generations', type=int, default=1000,
+                        help='stop a rule that has not reached a fixed point or cycle after this many generations')
+    parser.add_argument('--video-dir', help='directory to save a video of each rule to')
+    parser.add_argument('--fps', type=int, default=7)
+    parser.add_argument('--output', help='file to write a JSON line per rule to (default: stdout)')
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            trajectory_path = os.path.join(temp_dir, 'trajectory') if args.video_dir else None
+            start = time.perf_counter()
+            for rule, sim_run in sweep_rules(args.rule, args.input, args.max_generations,
+                                             trajectory_path=trajectory_path):
+                record = {'rule': rule_name(rule), 'generations': sim_run.generation, 'period': sim_run.period,
+                          'population': sim_run.counts[-1] if sim_run.counts else None,
+                          'seconds': time.perf_counter() - start}
+                out.write(json.dumps(record) + '\n')
+                out.flush()
+
+                if args.video_dir:
+                    os.makedirs(args.video_dir, exist_ok=True)
+                    file_name = rule_name(rule).replace(':', '_').replace('/', '_') + '.mp4'
+                    day11.stream_video(rule_frames(trajectory_path), os.path.join(args.video_dir, file_name),
+                                       args.fps)
+                start = time.perf_counter()
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import cycle_detection
+import instrumentation
+import population_stats
+import trajectory
+
+# Running a simulation with all the optional plumbing, shared by the seating plan (day 11) and hex tile (day 24)
+# simulations, and the rule engine.
+
+# Every run steps through cycle_detection.run_until_cycle, and can be recorded (trajectory.py), keep population
+# statistics (population_stats.py) and be observed (instrumentation.py). Each of these wraps the step, in that order,
+# so the observer times the recording and the statistics as part of the generation. The only things that differ
+# between the simulations are how to compare two states, and how to find the positions that are on.
+
+
+def run_observed(state, step, same_state, positions_on, is_on, base=None, shape=None, max_generations=None,
+                 observer=None, every=1, profiler=None, trajectory_path=None, keyframe_interval=16, stats=None,
+                 population=None, keep_state=None):
+    """
+    Run a simulation from state with cycle_detection.run_until_cycle, and return the CycleRun. step and same_state are
+    as for run_until_cycle, positions_on(state) returns the (n, 2) positions on in a state, and is_on(state, positions)
+    whether each position is on. base is an array kept with a trajectory (e.g. the seat layout), and shape the shape of
+    the grid the positions are in (None if they are unbounded). If an observer is passed, the step is wrapped with
+    instrumentation.observed_step so the observer gets a record of every every-th generation, with population(state)
+    (default: the number of positions on), and the steps are profiled if a cProfile.Profile is passed as profiler. If
+    a trajectory_path is passed, the run is saved there (see trajectory.py). If a dict is passed as stats, it is
+    filled with the population statistics of the state (see population_stats.py), kept up to date every generation.
+    If step reuses its states, keep_state must return a copy of a state (see run_until_cycle).
+    """
+    positions = positions_on(state)
+    recording = None
+    if trajectory_path is not None:
+        recording = trajectory.start_trajectory(trajectory_path, positions, shape)
+        step = trajectory.recorded_step(step, recording)
+
+    if population is None:
+        population = lambda state: len(positions_on(state))
+    if stats is not None:
+        stats.update(population_stats.new_stats(positions, shape))
+        step = population_stats.stats_step(step, stats, is_on)
+        population = lambda state: stats['population'] # no need to count again
+
+    finish_record = None
+    if observer is not None:
+        step, finish_record = instrumentation.observed_step(step, observer, population, every, profiler)
+    try:
+        sim_run = cycle_detection.run_until_cycle(state, step, same_state, positions, max_generations, keep_state)
+    finally:
+        if finish_record is not None:
+            finish_record()
+        if recording is not None:
+            recording['file'].close() # finish_trajectory closes it too, but not if the run fails
+
+    if recording is not None:
+        trajectory.finish_trajectory(recording, keyframe_interval, base=base, period=sim_run.period)
+
+    return sim_run
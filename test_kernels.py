@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+import day11_seatingPlanSimulation as day11
+import day24_flippingTiles as day24
+import numba_backend
+import trajectory
+
+# Checks that the fast kernels give exactly the same results as the original loop versions, on random seating plans
+# and random tiles. The numba kernels are skipped when numba is not installed.
+# Run with: python -m pytest test_kernels.py
+
+SEEDS = range(10)
+
+
+def random_seat_plan(seed):
+    """a random bordered seating plan of empty (-1), floor (0) and occupied (1) cells"""
+    rng = np.random.default_rng(seed)
+    rr, cc = rng.integers(1, 25, size=2)
+    sp = np.zeros((rr + 2, cc + 2), dtype=int)
+    sp[1:-1, 1:-1] = rng.choice([-1, 0, 1], size=(rr, cc), p=[0.4, 0.2, 0.4])
+    return sp
+
+
+def random_tiles_dict(seed):
+    """a random dict of tiles, black (-1) or white (1), in the doubled x coords of day 24"""
+    rng = np.random.default_rng(seed)
+    num_tiles = rng.integers(0, 200)
+    ys = rng.integers(-10, 10, size=num_tiles)
+    xs = 2*rng.integers(-10, 10, size=num_tiles) + ys % 2
+    return {(x, y): int(rng.choice([-1, 1])) for x, y in zip(xs.tolist(), ys.tolist())}
+
+
+def assert_same_rules(apply_rules, reference, sp):
+    """assert apply_rules returns the same plan, list of changes and stab as the reference loop version"""
+    spu_ref, changes_ref, stab_ref = reference(sp)
+    spu, changes, stab = day11.seat_change_lists(apply_rules)(sp)
+    assert np.array_equal(spu, spu_ref)
+    assert changes == changes_ref
+    assert stab == stab_ref
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_vectorised_rules(seed):
+    sp = random_seat_plan(seed)
+    assert_same_rules(day11.apply_rules_border_vectorised, day11.apply_rules_border_simultaneously, sp)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_sight_index_rules(seed):
+    sp = random_seat_plan(seed)
+    assert_same_rules(day11.sight_index_rules(sp), day11.apply_rules_border_diag_new, sp)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('part', [1, 2])
+def test_numba_seat_rules(seed, part):
+    if numba_backend.kernels_module() is None:
+        pytest.skip('numba is not installed')
+    sp = random_seat_plan(seed)
+    reference = day11.apply_rules_border_simultaneously if part == 1 else day11.apply_rules_border_diag_new
+    assert_same_rules(day11.numba_rules(sp, part), reference, sp)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('part', [1, 2])
+def test_incremental_simulation(seed, part):
+    sp = random_seat_plan(seed)
+    sp_start = sp.copy()
+    run_simulation = day11.run_simulation1 if part == 1 else day11.run_simulation2
+    sp_full, stab_full = run_simulation(sp)
+    sp_incremental, stab_incremental = run_simulation(sp, incremental=True)
+    assert np.array_equal(sp_incremental, sp_full)
+    assert stab_incremental == stab_full
+    assert np.array_equal(sp, sp_start) # the plan passed in is not changed
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('sweep_fraction', [0, 1])
+def test_frontier_rules(seed, sweep_fraction):
+    sp = random_seat_plan(seed)
+    apply_rules = day11.frontier_rules(sp, *day11.build_sight_index(sp), leave_at=5, sweep_fraction=sweep_fraction)
+    reference = day11.apply_rules_border_diag_new
+    sp_incremental = sp_reference = sp
+    for generation in range(10):
+        sp_incremental, changes, stab = day11.seat_change_lists(apply_rules)(sp_incremental)
+        sp_reference, changes_ref, stab_ref = reference(sp_reference)
+        assert np.array_equal(sp_incremental, sp_reference)
+        assert changes == changes_ref
+
+
+@pytest.mark.parametrize('part', [1, 2])
+@pytest.mark.parametrize('max_generations', [None, 3])
+def test_batch_simulation(part, max_generations):
+    plans = [random_seat_plan(seed) for seed in SEEDS]
+    final_plans, iterations, periods, occ_counts = day11.run_simulation_batch(plans, part, max_generations)
+    run_simulation = day11.run_simulation1 if part == 1 else day11.run_simulation2
+    apply_rules = day11.apply_rules_border_vectorised if part == 1 else day11.apply_rules_border_diag_new
+    for k, sp in enumerate(plans):
+        sp_final, stab_list = run_simulation(sp)
+        if (max_generations is not None) and (len(stab_list) > max_generations):
+            sp_final, stab_list = sp, stab_list[:max_generations]
+            for _ in range(max_generations):
+                sp_final = apply_rules(sp_final)[0]
+        assert np.array_equal(final_plans[k], sp_final)
+        assert iterations[k] == len(stab_list)
+        assert occ_counts[k] == np.sum(sp_final == 1)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_packed_simulation(seed, tmp_path):
+    sp = random_seat_plan(seed)
+    plan_file = tmp_path / 'plan.txt'
+    plan_file.write_text('\n'.join(''.join('L.#'[cell + 1] for cell in row) for row in sp[1:-1, 1:-1].tolist()) + '\n')
+    packed_plan = day11.load_seat_plan_packed(plan_file)
+    assert np.array_equal(day11.unpack_seat_plan(*packed_plan), sp)
+
+    sp_full, stab_full = day11.run_simulation1(sp)
+    packed_final, changes = day11.run_simulation1_packed(packed_plan)
+    assert np.array_equal(day11.unpack_seat_plan(*packed_final), sp_full)
+    assert len(changes) == len(stab_full)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_seat_plan_trajectory(seed, tmp_path):
+    sp = random_seat_plan(seed)
+    day11.run_observed(sp, day11.apply_rules_border_vectorised, trajectory_path=tmp_path, keyframe_interval=3)
+    traj = trajectory.load_trajectory(tmp_path)
+    replayed = list(day11.trajectory_seat_plans(tmp_path))
+    assert len(replayed) == traj.generations
+    for generation in range(traj.generations + 1):
+        assert np.array_equal(day11.seat_plan_from_trajectory(traj, generation), sp)
+        if generation > 0:
+            assert np.array_equal(replayed[generation - 1], sp)
+        sp = day11.apply_rules_border_vectorised(sp)[0]
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+@pytest.mark.parametrize('num_workers', [0, 2])
+@pytest.mark.parametrize('newline', ['\n', '\r\n'])
+def test_load_tiles_dict(seed, num_workers, newline, tmp_path):
+    rng = np.random.default_rng(seed)
+    lines = [''.join(rng.choice(['e', 'se', 'sw', 'w', 'nw', 'ne'], size=rng.integers(1, 12)))
+             for _ in range(rng.integers(1, 60))]
+    # blank lines in the middle and at the end are skipped
+    lines[len(lines) // 2:len(lines) // 2] = ['', '']
+    tiles_file = tmp_path / 'tiles.txt'
+    tiles_file.write_bytes((newline.join(lines) + newline + newline).encode())
+
+    reference = day24.flip_tiles_from_directions(day24.read_tile_directions(tiles_file))
+    # a small chunk_size splits the file into many chunks
+    assert day24.load_tiles_dict(tiles_file, chunk_size=16, num_workers=num_workers) == reference
+
+
+def dict_reference_black_tiles(tiles_dict):
+    """the black tiles after one generation of the original dict simulation"""
+    return day24.black_tiles_set(day24.flip_tiles_simultaneously(day24.create_dict_neighbs(tiles_dict)))
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_dense_grid_flip(seed):
+    tiles_dict = random_tiles_dict(seed)
+    grid, origin = day24.grow_dense_grid(*day24.tiles_dense_grid(tiles_dict))
+    assert day24.dense_grid_black_tiles(day24.flip_dense_grid(grid), origin) == dict_reference_black_tiles(tiles_dict)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_tile_engines(seed):
+    tiles_dict = random_tiles_dict(seed)
+    generations = 20
+    reference = day24.run_dict_simulation(dict(tiles_dict), generations)
+    assert day24.run_set_simulation(dict(tiles_dict), generations) == reference
+    assert day24.run_dense_simulation(dict(tiles_dict), generations) == reference
+    assert day24.run_double_buffered_tiles(dict(tiles_dict), generations) == reference
+    for generation in [1, 2, 7, generations]:
+        assert day24.hashlife_black_count(dict(tiles_dict), generation) == reference[generation - 1]
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_numba_hex_flip(seed):
+    kernels = numba_backend.kernels_module()
+    if kernels is None:
+        pytest.skip('numba is not installed')
+    tiles_dict = random_tiles_dict(seed)
+    grid, origin = day24.grow_dense_grid(*day24.tiles_dense_grid(tiles_dict))
+    assert day24.dense_grid_black_tiles(kernels.flip_hex_grid(grid), origin) == dict_reference_black_tiles(tiles_dict)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_tiles_trajectory(seed, tmp_path):
+    black_tiles = day24.black_tiles_set(random_tiles_dict(seed))
+    sim_run = day24.simulate_black_tiles(black_tiles, 20, trajectory_path=tmp_path, keyframe_interval=3)
+    for generation in range(sim_run.generation + 1):
+        assert day24.black_tiles_from_trajectory(tmp_path, generation) == black_tiles
+        black_tiles = day24.flip_black_tiles_step(black_tiles)[0]
@@ -0,0 +1,229 @@
+import collections
+import json
+import os
+import numpy as np
+import cycle_detection
+
+# On-disk record of a simulation run, shared by the seating plan (day 11) and hex tile (day 24) simulations.
+
+# A generation of either simulation only turns positions on or off: seats become occupied or empty, tiles become black
+# or white. So a run is stored as the positions that are on at the start (the occupied seats or black tiles), and the
+# positions that changed in each generation (the same changes cycle_detection hashes). Every keyframe_interval
+# generations the positions that are on are stored as well (a keyframe), so any generation can be rebuilt from the
+# keyframe before it plus at most keyframe_interval - 1 generations of changes, without simulating.
+
+# The positions are cells of a grid: the seating plan for a run with a known shape, otherwise the box around every
+# position that is ever on (e.g. the hex tiles, in their doubled x coords). The changes of each generation are written
+# to deltas.bin as the run goes, rather than kept in memory, as int32 flat indices into the grid, or as a bit per cell
+# (np.packbits) when more than one cell in DENSE_DELTA changes, whichever is smaller. A run without a known shape
+# writes (row, col) int32 pairs instead, as the box is only known at the end. The keyframes are bit per cell grids,
+# made at the end by replaying the changes into a boolean grid.
+
+# The arrays are saved as .npy files in a directory, with the sizes and settings in meta.json, and are memory mapped
+# when loaded, so only the keyframe and changes that are needed are read. If the run ended on a cycle, its period is
+# kept, so later generations can be found on the cycle too.
+
+# a trajectory loaded by load_trajectory: the optional base array (e.g. the seat layout), the number of generations
+# stored, the keyframe interval, the period of the cycle the run ended on (or None), the (row, col) of the grid's [0, 0]
+# and its shape, the bit per cell keyframes (one row each), and the changes, where the changes of generation g are
+# delta_bytes[delta_offsets[g - 1]:delta_offsets[g]], encoded as delta_kinds[g - 1]
+Trajectory = collections.namedtuple('Trajectory', ['base', 'generations', 'keyframe_interval', 'period', 'origin',
+                                                   'shape', 'keyframes', 'delta_offsets', 'delta_kinds',
+                                                   'delta_bytes'])
+
+# how the changes of a generation are encoded: int32 flat indices into the grid, a bit per cell, or int32 (row, col)
+DELTA_FLAT, DELTA_MASK, DELTA_PAIRS = 0, 1, 2
+
+# the changes of a generation are stored a bit per cell once more than 1 in DENSE_DELTA cells change (as a flat index
+# takes 32 bits)
+DENSE_DELTA = 32
+
+
+def start_trajectory(path, initial_positions, shape=None):
+    """
+    Start recording a run to the directory path, from the (n, 2) positions on at the start, on a grid of the given
+    shape (None if the positions are unbounded). Returns the recording, to pass to record_generation and
+    finish_trajectory.
+    """
+    os.makedirs(path, exist_ok=True)
+    initial_positions = np.asarray(initial_positions, dtype=np.int64).reshape(-1, 2)
+    recording = {'path': path, 'initial': initial_positions, 'shape': shape, 'offsets': [0], 'kinds': [],
+                 'low': initial_positions.min(axis=0, initial=np.iinfo(np.int64).max),
+                 'high': initial_positions.max(axis=0, initial=np.iinfo(np.int64).min),
+                 'file': open(os.path.join(path, 'deltas.bin'), 'wb')}
+    return recording
+
+
+def record_generation(recording, changed):
+    """write the (n, 2) positions that changed in a generation to the recording"""
+    changed = np.asarray(changed, dtype=np.int64).reshape(-1, 2)
+    shape = recording['shape']
+    if shape is None:
+        recording['low'] = np.minimum(recording['low'], changed.min(axis=0, initial=np.iinfo(np.int64).max))
+        recording['high'] = np.maximum(recording['high'], changed.max(axis=0, initial=np.iinfo(np.int64).min))
+        kind, data = DELTA_PAIRS, changed.astype(np.int32)
+    else:
+        flat = changed[:, 0] * shape[1] + changed[:, 1]
+        if len(flat) * DENSE_DELTA > shape[0] * shape[1]:
+            mask = np.zeros(shape[0] * shape[1], dtype=bool)
+            mask[flat] = True
+            kind, data = DELTA_MASK, np.packbits(mask)
+        else:
+            kind, data = DELTA_FLAT, flat.astype(np.int32)
+
+    recording['file'].write(data.tobytes())
+    recording['offsets'].append(recording['offsets'][-1] + data.nbytes)
+    recording['kinds'].append(kind)
+
+
+def recorded_step(step, recording):
+    """
+    wrap a simulation step (as used by cycle_detection.run_until_cycle) so the positions that change in each
+    generation are written to the recording (see start_trajectory)
+    """
+    def wrapped_step(state):
+        state, changed, count = step(state)
+        record_generation(recording, changed)
+        return state, changed, count
+
+    return wrapped_step
+
+
+def finish_trajectory(recording, keyframe_interval=16, base=None, period=None):
+    """
+    Finish a recording: write the keyframes every keyframe_interval generations, base (an optional array to keep with
+    the run, e.g. the seat layout), and period (the period of the cycle the run ended on, if any)
+    """
+    recording['file'].close()
+    if keyframe_interval < 1:
+        raise ValueError(f'keyframe_interval must be at least 1, not {keyframe_interval}')
+
+    path = recording['path']
+    arrays = {
+        'delta_offsets': np.array(recording['offsets'], dtype=np.int64),
+        'delta_kinds': np.array(recording['kinds'], dtype=np.uint8),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+
+    # the grid of a run without a known shape is the box around every position that is ever on
+    if recording['shape'] is not None:
+        origin, shape = (0, 0), tuple(recording['shape'])
+    elif recording['low'][0] > recording['high'][0]:
+        origin, shape = (0, 0), (1, 1) # nothing is ever on
+    else:
+        origin = tuple(recording['low'].tolist())
+        shape = tuple((recording['high'] - recording['low'] + 1).tolist())
+
+    meta = {'generations': len(recording['kinds']), 'keyframe_interval': keyframe_interval, 'period': period,
+            'has_base': base is not None, 'origin': origin, 'shape': shape}
+    traj = load_arrays(path, meta, base)
+
+    # replay the changes into a grid to make the keyframes
+    grid = np.zeros(shape, dtype=bool)
+    grid[tuple((recording['initial'] - origin).T)] = True
+    keyframes = np.empty((traj.generations // keyframe_interval + 1, (grid.size + 7) // 8), dtype=np.uint8)
+    keyframes[0] = np.packbits(grid)
+    for generation in range(1, traj.generations + 1):
+        toggle_generation(grid, traj, generation)
+        if generation % keyframe_interval == 0:
+            keyframes[generation // keyframe_interval] = np.packbits(grid)
+    np.save(os.path.join(path, 'keyframes.npy'), keyframes)
+    if base is not None:
+        np.save(os.path.join(path, 'base.npy'), base)
+
+    # meta.json is written last, so a directory without it is an unfinished trajectory
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def save_trajectory(path, initial_positions, deltas, keyframe_interval=16, base=None, period=None, shape=None):
+    """
+    Save a run to the directory path: the positions on at the start, and the (n, 2) arrays of positions that changed in
+    each generation, on a grid of the given shape (None if the positions are unbounded). See finish_trajectory for the
+    other arguments.
+    """
+    recording = start_trajectory(path, initial_positions, shape)
+    for changed in deltas:
+        record_generation(recording, changed)
+    finish_trajectory(recording, keyframe_interval, base, period)
+
+
+def load_arrays(path, meta, base=None):
+    """returns the Trajectory in path with the settings in meta, with the arrays written so far memory mapped"""
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+              for name in ['delta_offsets', 'delta_kinds']}
+    keyframes_path = os.path.join(path, 'keyframes.npy')
+    arrays['keyframes'] = np.load(keyframes_path, mmap_mode='r') if os.path.exists(keyframes_path) else None
+
+    # np.memmap cannot map an empty file
+    deltas_path = os.path.join(path, 'deltas.bin')
+    if os.path.getsize(deltas_path) > 0:
+        arrays['delta_bytes'] = np.memmap(deltas_path, dtype=np.uint8, mode='r')
+    else:
+        arrays['delta_bytes'] = np.empty(0, dtype=np.uint8)
+
+    return Trajectory(base, meta['generations'], meta['keyframe_interval'], meta['period'], tuple(meta['origin']),
+                      tuple(meta['shape']), **arrays)
+
+
+def load_trajectory(path):
+    """load a trajectory saved by save_trajectory or finish_trajectory, with its arrays memory mapped"""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    base = np.load(os.path.join(path, 'base.npy')) if meta['has_base'] else None
+    return load_arrays(path, meta, base)
+
+
+def toggle_generation(grid, traj, generation):
+    """switch the cells of the boolean grid that changed in a generation (from 1) stored in the trajectory"""
+    data = traj.delta_bytes[traj.delta_offsets[generation - 1]:traj.delta_offsets[generation]]
+    kind = traj.delta_kinds[generation - 1]
+    if kind == DELTA_MASK:
+        grid ^= np.unpackbits(data, count=grid.size).view(bool).reshape(grid.shape)
+    else:
+        # the positions changed in a generation are all different, so each is switched once
+        positions = np.frombuffer(data, dtype=np.int32)
+        if kind == DELTA_PAIRS:
+            positions = positions.reshape(-1, 2) - np.asarray(traj.origin)
+            positions = positions[:, 0] * grid.shape[1] + positions[:, 1]
+        grid.ravel()[positions] ^= True
+
+
+def generation_deltas(traj, generation):
+    """returns the (n, 2) array of positions that changed in a generation (from 1) stored in the trajectory"""
+    data = traj.delta_bytes[traj.delta_offsets[generation - 1]:traj.delta_offsets[generation]]
+    kind = traj.delta_kinds[generation - 1]
+    if kind == DELTA_PAIRS:
+        return np.frombuffer(data, dtype=np.int32).reshape(-1, 2).astype(np.int64)
+
+    if kind == DELTA_MASK:
+        flat = np.flatnonzero(np.unpackbits(data, count=traj.shape[0] * traj.shape[1]))
+    else:
+        flat = np.frombuffer(data, dtype=np.int32).astype(np.int64)
+    return np.column_stack(np.divmod(flat, traj.shape[1])) + np.asarray(traj.origin)
+
+
+def grid_at_generation(traj, generation):
+    """
+    Returns a boolean grid (of traj.shape, with traj.origin at [0, 0]) of the positions that are on at any generation.
+    Generations after the ones stored are found on the cycle the run ended on (an error if there was none).
+    """
+    run = cycle_detection.CycleRun(None, traj.generations, traj.period, None)
+    generation = cycle_detection.cycle_generation(run, generation)
+
+    # the keyframe before the generation, and the changes since it
+    k = generation // traj.keyframe_interval
+    grid = np.unpackbits(traj.keyframes[k], count=traj.shape[0] * traj.shape[1]).view(bool).reshape(traj.shape)
+    for g in range(k * traj.keyframe_interval + 1, generation + 1):
+        toggle_generation(grid, traj, g)
+    return grid
+
+
+def positions_at_generation(traj, generation):
+    """
+    Returns the (n, 2) array of positions that are on at any generation, in sorted order. Generations after the ones
+    stored are found on the cycle the run ended on (an error if there was none).
+    """
+    return np.argwhere(grid_at_generation(traj, generation)) + np.asarray(traj.origin)